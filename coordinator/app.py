@@ -1,17 +1,49 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template_string
+from flask import Flask, request, jsonify, send_from_directory, render_template_string, make_response
 from flask_socketio import SocketIO, emit
 import os, sqlite3, hashlib, json, pathlib, logging, time, threading
+import atexit
+import errno
+import hmac
+import mimetypes
+import queue
+import ssl
+import struct
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import Future
 from datetime import datetime, timedelta
-from collections import defaultdict
+from urllib.parse import quote
 import signal
 import sys
+import unicodedata
 import io
 
+try:
+    from eventlet import tpool
+except ImportError:
+    tpool = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Configuration
 BASE_DIR = pathlib.Path(__file__).resolve().parent
-UPLOAD_DIR = BASE_DIR / "uploads"
-DB_PATH = BASE_DIR / "state.db"
-LOG_DIR = BASE_DIR / "logs"
+# Database, uploads and logs live here (default: next to this file)
+DATA_DIR = pathlib.Path(os.environ.get("SFTS_DATA_DIR", BASE_DIR))
+UPLOAD_DIR = DATA_DIR / "uploads"
+DB_PATH = DATA_DIR / "state.db"
+LOG_DIR = DATA_DIR / "logs"
+# Behind a reverse proxy, let it send downloads straight from disk: "nginx"
+# returns X-Accel-Redirect under XSENDFILE_PREFIX, "apache" returns X-Sendfile
+USE_XSENDFILE = os.environ.get("USE_XSENDFILE", "").strip().lower()
+XSENDFILE_PREFIX = os.environ.get("XSENDFILE_PREFIX", "/_protected")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(LOG_DIR, exist_ok=True)
 
@@ -27,33 +59,551 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+if USE_XSENDFILE not in ('', 'nginx', 'apache'):
+    logger.warning(f"Ignoring USE_XSENDFILE={USE_XSENDFILE!r} (expected nginx or apache); streaming downloads")
+    USE_XSENDFILE = ''
+
+# hashlib's sha256 goes through OpenSSL's EVP interface, which picks the
+# SHA-NI/AVX2 code path at runtime when the CPU supports it.
+assert 'sha256' in hashlib.algorithms_guaranteed
+SHA256_BACKEND = ssl.OPENSSL_VERSION if type(hashlib.sha256()).__module__ == '_hashlib' else 'builtin'
+logger.info(f"Chunk checksums: {hashlib.new('sha256').name} ({SHA256_BACKEND})")
+# Chunk hash algorithms a manifest may name in its "alg" field
+HASH_ALGORITHMS = {'sha256': hashlib.sha256}
+if blake3 is not None:
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+logger.info(f"Chunk hash algorithms: {', '.join(HASH_ALGORITHMS)}")
+# Chunk body encodings a raw PUT may name in its X-Encoding header
+CHUNK_ENCODINGS = ['zstd'] if zstandard is not None else []
+CHUNK_DECODE_ERRORS = (zstandard.ZstdError,) if zstandard is not None else ()
+HASH_BLOCK_SIZE = 1024 * 1024
+# Raw chunk bodies larger than this are spooled to a temp file, not memory
+CHUNK_SPOOL_MEMORY = 512 * 1024
+# Record header in a /upload/chunks_batch body: chunk_id, data length, raw
+# digest (SHA-256 and BLAKE3 are both 32 bytes); the chunk data follows
+BATCH_RECORD = struct.Struct('>II32s')
+
 # Flask app setup
 app = Flask(__name__, static_folder=str(BASE_DIR / 'static'))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max chunk size
+app.config['USE_X_SENDFILE'] = USE_XSENDFILE == 'apache'
 socketio = SocketIO(app, cors_allowed_origins='*', logger=False, engineio_logger=False)
 
-# Global state for monitoring
-transfer_stats = defaultdict(lambda: {
-    'start_time': None,
-    'last_activity': None,
-    'bytes_received': 0,
-    'chunks_received': 0,
-    'errors': 0
-})
+# Dashboard events are queued and fanned out by a background task so request
+# handlers never wait on WebSocket delivery to connected clients.
+emit_q = queue.Queue()
+EMIT_INTERVAL = 0.05  # seconds between queue drains
+EMIT_COALESCE_THRESHOLD = 32  # backlog size at which chunk progress is coalesced
+
+def _emit_worker():
+    """
+    Drain emit_q and emit to dashboard clients. When a backlog builds up, only
+    the newest 'chunk' progress event per file_id is sent.
+    """
+    while True:
+        batch = []
+        try:
+            while True:
+                batch.append(emit_q.get_nowait())
+        except queue.Empty:
+            pass
+        if len(batch) > EMIT_COALESCE_THRESHOLD:
+            latest = {payload['file_id']: i for i, (event, payload) in enumerate(batch) if event == 'chunk'}
+            batch = [(event, payload) for i, (event, payload) in enumerate(batch)
+                     if event != 'chunk' or latest[payload['file_id']] == i]
+        for event, payload in batch:
+            try:
+                socketio.emit(event, payload)
+            except Exception as e:
+                logger.error(f"Failed to emit {event}: {e}")
+        socketio.sleep(EMIT_INTERVAL)
+
+socketio.start_background_task(_emit_worker)
+
+# Per-connection SQLite tuning. journal_mode=WAL persists in the database
+# file, so it is set once in init_db() rather than on every connect.
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",      # 64 MiB page cache
+    "PRAGMA mmap_size=10737418240",  # 10 GiB
+    "PRAGMA busy_timeout=5000",
+)
+DB_MAINTENANCE_INTERVAL = 15 * 60  # seconds
+# sqlite3 keeps this many compiled statements per connection, keyed by SQL text
+DB_STATEMENT_CACHE = 256
+
+# Enhanced SQLite state management + migration
+def _apply_pragmas(conn):
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+
+# Received chunks are tracked as a bitmap BLOB on the manifest row: bit i
+# (byte i >> 3, mask 1 << (i & 7)) is set once chunk i has been stored.
+def _set_bit(bitmap, idx):
+    bits = bytearray(bitmap)
+    bits[idx >> 3] |= 1 << (idx & 7)
+    return bytes(bits)
+
+def _get_bit(bitmap, idx):
+    return (bitmap[idx >> 3] >> (idx & 7)) & 1
+
+def _missing_chunks(bitmap, total):
+    """
+    Return the ids of chunks whose bit is clear, in ascending order.
+    """
+    missing = []
+    for byte_idx, byte in enumerate(bitmap):
+        if byte == 0xFF:
+            continue
+        clear = ~byte & 0xFF
+        while clear:
+            low = clear & -clear
+            missing.append((byte_idx << 3) + low.bit_length() - 1)
+            clear ^= low
+    # Padding bits past the last chunk are never set
+    while missing and missing[-1] >= total:
+        missing.pop()
+    return missing
+
+# One cached connection per worker thread, keyed by thread ident, so the page
+# cache stays warm across requests instead of reconnecting every time.
+_db_connections = {}
+_db_connections_lock = threading.Lock()
+
+def get_db_connection():
+    """
+    Return the calling thread's SQLite connection, opening it on first use.
+    Connections run in autocommit mode; group writes with db_transaction().
+    """
+    ident = threading.get_ident()
+    conn = _db_connections.get(ident)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30.0, check_same_thread=False, isolation_level=None,
+                               cached_statements=DB_STATEMENT_CACHE)
+        conn.row_factory = sqlite3.Row
+        conn.create_function('set_bit', 2, _set_bit, deterministic=True)
+        conn.create_function('get_bit', 2, _get_bit, deterministic=True)
+        _apply_pragmas(conn)
+        with _db_connections_lock:
+            # Threaded servers may use a thread per request; drop connections
+            # owned by threads that have exited so they do not pile up.
+            alive = {t.ident for t in threading.enumerate()}
+            for stale in [i for i in _db_connections if i not in alive]:
+                _db_connections.pop(stale).close()
+            _db_connections[ident] = conn
+    return conn
+
+def close_db_connections():
+    """
+    Close every cached connection. Registered with atexit.
+    """
+    with _db_connections_lock:
+        while _db_connections:
+            _, conn = _db_connections.popitem()
+            conn.close()
+
+atexit.register(close_db_connections)
+
+@contextmanager
+def db_transaction(conn):
+    """
+    Run the enclosed statements as one BEGIN IMMEDIATE ... COMMIT, rolling back on error.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def _ensure_columns(cursor, table, required_defs):
+    """
+    Add missing columns to a table without dropping data.
+    required_defs: list of column definitions like "status TEXT DEFAULT 'active'"
+    Returns the names of the columns that were added.
+    """
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    added = []
+    for col_def in required_defs:
+        name = col_def.split()[0]
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {col_def}")
+            added.append(name)
+    return added
+
+# Each transfer is written into one preallocated container file; the fds stay
+# open for the life of the transfer and are shared by all upload threads
+_containers = {}
+_containers_lock = threading.Lock()
+
+class _Container:
+    """
+    The open container fd of one transfer. Writers hold it with acquire() and
+    release(); once close() is called no new writer gets in, and the fd is
+    closed by whoever lets go last. A late write (e.g. a duplicate racing
+    assembly) is refused instead of landing in a file that reused the fd number.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self._writers = 0
+        self._closed = False
+    
+    def acquire(self):
+        with _containers_lock:
+            if self._closed:
+                return False
+            self._writers += 1
+            return True
+    
+    def release(self):
+        with _containers_lock:
+            self._writers -= 1
+            last = self._closed and not self._writers
+        if last:
+            os.close(self.fd)
+    
+    def close(self):
+        with _containers_lock:
+            if self._closed:
+                return
+            self._closed = True
+            last = not self._writers
+        if last:
+            os.close(self.fd)
+
+# posix_fallocate errors meaning the filesystem cannot preallocate; anything
+# else (ENOSPC, EDQUOT, ...) means the transfer does not fit and must fail now
+FALLOCATE_UNSUPPORTED = {errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS}
+
+def _container_path(file_id):
+    return UPLOAD_DIR / f'{file_id}.part'
+
+def _create_container(file_id, size):
+    """
+    (Re)create the container file of a transfer, reserving size bytes up front.
+    Raises OSError if the space cannot be reserved; the file is removed then.
+    """
+    _close_container(file_id)
+    path = _container_path(file_id)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except AttributeError:
+            # No fallocate here; a sparse file of the right length will do
+            os.ftruncate(fd, size)
+        except OSError as e:
+            if e.errno not in FALLOCATE_UNSUPPORTED:
+                raise
+            os.ftruncate(fd, size)
+    except OSError:
+        os.close(fd)
+        path.unlink(missing_ok=True)
+        raise
+    container = _Container(fd)
+    with _containers_lock:
+        _containers[file_id] = container
+    return container
+
+def _get_container(file_id):
+    """
+    Return the _Container of a transfer, reopening its file after a restart.
+    """
+    with _containers_lock:
+        container = _containers.get(file_id)
+        if container is None:
+            container = _Container(os.open(_container_path(file_id), os.O_RDWR | getattr(os, 'O_BINARY', 0)))
+            _containers[file_id] = container
+        return container
+
+def _close_container(file_id):
+    with _containers_lock:
+        container = _containers.pop(file_id, None)
+    if container is not None:
+        container.close()
+
+def _read_chunk(stream, new_hash=hashlib.sha256, limit=None):
+    """
+    Hash an upload stream in 1 MiB reads. Returns (digest, length, data), where
+    data is the stream itself if seekable, else a spool filled while hashing.
+    With a limit, reading stops after limit + 1 bytes so oversized (e.g.
+    decompressed) chunks are rejected without being read in full.
+    """
+    data = stream if stream.seekable() else tempfile.SpooledTemporaryFile(CHUNK_SPOOL_MEMORY)
+    digest = new_hash()
+    length = 0
+    if limit is None:
+        read_block = lambda: stream.read(HASH_BLOCK_SIZE)
+    else:
+        read_block = lambda: stream.read(min(HASH_BLOCK_SIZE, limit + 1 - length)) if length <= limit else b''
+    for block in iter(read_block, b''):
+        digest.update(block)
+        if data is not stream:
+            data.write(block)
+        length += len(block)
+    return digest.digest(), length, data
+
+def _write_at(fd, stream, offset):
+    """
+    Copy an upload stream into fd at offset without using the shared file position.
+    """
+    stream.seek(0)
+    for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b''):
+        if not hasattr(os, 'pwrite'):
+            with _containers_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, block)
+            offset += len(block)
+            continue
+        view = memoryview(block)
+        while view:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+
+class _RecordStream:
+    """
+    The next `length` bytes of a batch body, read as one chunk's upload stream.
+    Not seekable, so _read_chunk() spools it like any streamed chunk.
+    """
+    def __init__(self, stream, length):
+        self._stream = stream
+        self.remaining = length
+    
+    def seekable(self):
+        return False
+    
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        block = self._stream.read(n) if n else b''
+        self.remaining -= len(block)
+        return block
+    
+    def drain(self):
+        """Skip whatever the chunk handler did not read, e.g. for a duplicate"""
+        while self.remaining and self.read(HASH_BLOCK_SIZE):
+            pass
+
+def _read_exact(stream, n):
+    """Read n bytes, or fewer only at end of stream"""
+    buf = b''
+    while len(buf) < n:
+        block = stream.read(n - len(buf))
+        if not block:
+            break
+        buf += block
+    return buf
+
+def _offloading():
+    return tpool is not None and socketio.async_mode == 'eventlet'
+
+def _offload(fn, *args):
+    """
+    Run blocking hash/disk work on eventlet's OS thread pool when serving under
+    eventlet, so concurrent chunks hash in parallel instead of stalling the hub.
+    Threaded servers already give each request its own thread, so run inline.
+    Never pass request.stream itself; see _request_body().
+    """
+    if _offloading():
+        return tpool.execute(fn, *args)
+    return fn(*args)
+
+@contextmanager
+def _request_body():
+    """
+    Yield the request body as a stream that _offload() may hand to a pool
+    thread. Under eventlet request.stream reads the hub's green socket, which
+    must not be used from tpool's OS threads, so the body is spooled on the
+    hub first. Threaded servers read it straight off the socket.
+    """
+    if not _offloading():
+        yield request.stream
+        return
+    spool = tempfile.SpooledTemporaryFile(CHUNK_SPOOL_MEMORY)
+    try:
+        for block in iter(lambda: request.stream.read(HASH_BLOCK_SIZE), b''):
+            spool.write(block)
+        spool.seek(0)
+        yield spool
+    finally:
+        spool.close()
 
-# Simple SQLite state: manifests table
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    """
+    Create tables if needed and ensure columns used by routes exist.
+    """
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS manifests
-                 (file_id TEXT PRIMARY KEY, filename TEXT, size INTEGER, chunk_size INTEGER, total_chunks INTEGER, merkle TEXT, priority TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS chunks
-                 (file_id TEXT, chunk_id INTEGER, checksum TEXT, received INTEGER, PRIMARY KEY(file_id, chunk_id))''')
-    conn.commit()
-    conn.close()
+    c.execute('PRAGMA journal_mode=WAL')
+    # Versions before bitmaps kept per-chunk rows in a separate chunks.db
+    legacy_db = DATA_DIR / 'chunks.db'
+    if legacy_db.exists():
+        c.execute('ATTACH DATABASE ? AS legacy', (str(legacy_db),))
+    with db_transaction(conn):
+        # Base tables
+        c.execute('''CREATE TABLE IF NOT EXISTS manifests (
+            file_id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            total_chunks INTEGER NOT NULL
+        )''')
+        # Migrate extra columns used by current code
+        _ensure_columns(c, 'manifests', [
+            "merkle TEXT",
+            "priority TEXT DEFAULT 'normal'",
+            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+            "completed_at TIMESTAMP",
+            "status TEXT DEFAULT 'active'",
+            "received_chunks INTEGER DEFAULT 0",
+            "recv_bitmap BLOB",
+            "checksums BLOB",
+            "alg TEXT DEFAULT 'sha256'"
+        ])
+        _migrate_chunk_rows(c, 'main')
+        if legacy_db.exists():
+            _migrate_chunk_rows(c, 'legacy')
+        c.execute('UPDATE manifests SET recv_bitmap = zeroblob((total_chunks + 7) / 8) WHERE recv_bitmap IS NULL')
+        # Stats table
+        c.execute('''CREATE TABLE IF NOT EXISTS transfer_stats (
+            file_id TEXT PRIMARY KEY,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            total_bytes INTEGER,
+            chunks_received INTEGER,
+            errors INTEGER DEFAULT 0,
+            avg_speed REAL,
+            FOREIGN KEY(file_id) REFERENCES manifests(file_id)
+        )''')
+        _ensure_columns(c, 'transfer_stats', [
+            "bytes_received INTEGER DEFAULT 0",
+            "last_activity TIMESTAMP"
+        ])
+        # Indexes
+        c.execute('CREATE INDEX IF NOT EXISTS idx_manifests_status ON manifests(status)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_manifests_priority ON manifests(priority)')
+    if legacy_db.exists():
+        c.execute('DETACH DATABASE legacy')
+        for suffix in ('', '-wal', '-shm'):
+            pathlib.Path(f'{legacy_db}{suffix}').unlink(missing_ok=True)
+
+def _migrate_chunk_rows(cursor, schema):
+    """
+    Fold per-chunk rows left by older versions into manifest bitmaps, then drop them.
+    """
+    cursor.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = 'chunks'")
+    if not cursor.fetchone():
+        return
+    cursor.execute('SELECT file_id, total_chunks FROM manifests WHERE recv_bitmap IS NULL')
+    for file_id, total in cursor.fetchall():
+        bitmap = bytearray((total + 7) // 8)
+        checksums = bytearray(32 * total)
+        cursor.execute(f'SELECT chunk_id, checksum, received FROM {schema}.chunks WHERE file_id = ?', (file_id,))
+        for chunk_id, checksum, received in cursor.fetchall():
+            if not 0 <= chunk_id < total:
+                continue
+            if isinstance(checksum, str):
+                checksum = bytes.fromhex(checksum)
+            if len(checksum) == 32:
+                checksums[32 * chunk_id:32 * (chunk_id + 1)] = checksum
+            if received:
+                bitmap[chunk_id >> 3] |= 1 << (chunk_id & 7)
+        cursor.execute('UPDATE manifests SET recv_bitmap = ?, checksums = ?, received_chunks = ? WHERE file_id = ?',
+                       (bytes(bitmap), bytes(checksums), sum(bin(b).count('1') for b in bitmap), file_id))
+    cursor.execute(f'DROP TABLE {schema}.chunks')
+
+def cleanup_stale_transfers():
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        stale_time = datetime.now() - timedelta(hours=1)
+        c.execute("SELECT file_id FROM manifests WHERE status='active' AND created_at < ?", (stale_time,))
+        stale = [row['file_id'] for row in c.fetchall()]
+        c.executemany("UPDATE manifests SET status='stale' WHERE file_id=?", [(file_id,) for file_id in stale])
+        for file_id in stale:
+            _chunk_handlers.pop(file_id, None)
+            # Stale transfers are never resumed (a new init recreates the
+            # container), so release their preallocated space now
+            _close_container(file_id)
+            _container_path(file_id).unlink(missing_ok=True)
+    except sqlite3.Error as e:
+        logger.error(f"Error cleaning up stale transfers: {e}")
+
+def db_maintenance():
+    """
+    Periodically checkpoint the WAL back into the main file and refresh planner stats.
+    """
+    while True:
+        time.sleep(DB_MAINTENANCE_INTERVAL)
+        try:
+            conn = get_db_connection()
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('PRAGMA optimize')
+        except sqlite3.Error as e:
+            logger.error(f"Error during database maintenance: {e}")
+
+# Chunk bookkeeping is written by a single writer thread, which commits every
+# write queued within DB_WRITER_WINDOW as one transaction (group commit).
+db_write_q = queue.Queue()
+DB_WRITER_BATCH = 128  # max writes per transaction
+DB_WRITER_WINDOW = 0.005  # seconds to wait for more writes after the first
+
+def db_write(fn):
+    """
+    Run fn(cursor) on the writer thread and return its result once committed.
+    fn runs inside the batch transaction and must not begin or commit its own.
+    """
+    future = Future()
+    db_write_q.put((fn, future))
+    return future.result()
+
+def _db_writer():
+    conn = get_db_connection()
+    c = conn.cursor()
+    while True:
+        batch = [db_write_q.get()]
+        deadline = time.monotonic() + DB_WRITER_WINDOW
+        while len(batch) < DB_WRITER_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(db_write_q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        outcomes = []
+        try:
+            with db_transaction(conn):
+                for fn, future in batch:
+                    # A savepoint per write, so one failure does not undo the rest of the batch
+                    c.execute('SAVEPOINT write')
+                    try:
+                        outcomes.append((future, fn(c), None))
+                        c.execute('RELEASE write')
+                    except Exception as e:
+                        c.execute('ROLLBACK TO write')
+                        c.execute('RELEASE write')
+                        outcomes.append((future, None, e))
+        except Exception as e:
+            logger.error(f"Group commit of {len(batch)} writes failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            continue
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
 
 init_db()
+threading.Thread(target=lambda: (time.sleep(3600), cleanup_stale_transfers()), daemon=True).start()
+threading.Thread(target=db_maintenance, daemon=True).start()
+threading.Thread(target=_db_writer, daemon=True).start()
 
 @app.route('/')
 def index():
@@ -70,22 +620,325 @@ def upload_init():
     filename = data['filename']
     size = data['size']
     chunk_size = data['chunk_size']
-    chunks = data['chunks']  # list of {chunk_id, checksum, size}
     priority = data.get('priority', 'normal')
+    alg = data.get('alg', 'sha256')
+    if alg not in HASH_ALGORITHMS:
+        return jsonify({'error': f'Unsupported hash algorithm: {alg}'}), 400
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''INSERT OR REPLACE INTO manifests
-                 (file_id, filename, size, chunk_size, total_chunks, merkle, priority, status)
-                 VALUES (?,?,?,?,?,?,?,?)''',
-              (file_id, filename, size, chunk_size, len(chunks), '', priority, 'active'))
-    for ch in chunks:
-        c.execute('INSERT OR REPLACE INTO chunks (file_id, chunk_id, checksum, received) VALUES (?,?,?,?)',
-                  (file_id, ch['chunk_id'], ch['checksum'], 0))
-    conn.commit()
-    conn.close()
-    socketio.emit('manifest', {'file_id': file_id, 'filename': filename, 'size': size, 'total_chunks': len(chunks), 'priority': priority})
+    c.execute('SELECT status, filename, size, chunk_size, total_chunks, received_chunks, recv_bitmap, alg, merkle '
+              'FROM manifests WHERE file_id=?', (file_id,))
+    row = c.fetchone()
+    same_file = row is not None and row['alg'] == alg and (row['size'], row['chunk_size']) == (size, chunk_size)
+    if row and row['status'] == 'completed':
+        # Senders derive file_id from the file itself, so sending it again after
+        # success lands here; never reset a finished transfer to an empty one
+        if same_file:
+            return jsonify({'status': 'completed'})
+        return jsonify({'error': 'file_id belongs to a completed transfer'}), 409
+    if data.get('resume'):
+        # Resume probe: sent before the sender hashes anything, so it can skip
+        # the chunks listed here. Only an active transfer of the same file on
+        # the same grid is picked up again; the file may have been renamed.
+        if same_file and row['status'] == 'active':
+            if row['filename'] != filename:
+                with db_transaction(conn):
+                    c.execute('UPDATE manifests SET filename = ? WHERE file_id = ?', (filename, file_id))
+                # Rebuilt from the manifest on the next chunk, with the new name
+                _chunk_handlers.pop(file_id, None)
+            missing = set(_missing_chunks(row['recv_bitmap'], row['total_chunks']))
+            return jsonify({'status': 'resumed', 'received_chunks': row['received_chunks'],
+                            'received_chunk_ids': [i for i in range(row['total_chunks']) if i not in missing],
+                            'checksums_pending': row['merkle'] is None})
+        if 'chunks' not in data and not data.get('defer_checksums'):
+            return jsonify({'status': 'new'})
+    if data.get('defer_checksums'):
+        # Chunks may be uploaded while the sender is still hashing; the digests
+        # (and so the merkle root) arrive via /upload/checksums before assembly
+        total = (size + chunk_size - 1) // chunk_size
+        checksums = merkle = None
+    else:
+        chunks = data['chunks']  # list of {chunk_id, checksum, size}
+        total = len(chunks)
+        checksums = b''.join(bytes.fromhex(ch['checksum']) for ch in sorted(chunks, key=lambda ch: ch['chunk_id']))
+        # Root of a two-level Merkle tree over the chunk digests; lets a
+        # downloader verify the whole file while streaming it
+        merkle = HASH_ALGORITHMS[alg](checksums).hexdigest()
+    # Reserve the space before recording the transfer, so a full disk is
+    # reported now rather than by a failed pwrite halfway through the upload
+    try:
+        _create_container(file_id, size)
+    except OSError as e:
+        logger.error(f"Cannot allocate {size} bytes for {file_id}: {e}")
+        if e.errno in (errno.ENOSPC, errno.EDQUOT):
+            return jsonify({'error': 'Insufficient storage for this file'}), 507
+        return jsonify({'error': 'Failed to create transfer file'}), 500
+    _chunk_handlers.pop(file_id, None)
+    with db_transaction(conn):
+        c.execute('''INSERT OR REPLACE INTO manifests
+                     (file_id, filename, size, chunk_size, total_chunks, merkle, priority, status, recv_bitmap, checksums, alg)
+                     VALUES (?,?,?,?,?,?,?,?,zeroblob(?),?,?)''',
+                  (file_id, filename, size, chunk_size, total, merkle, priority, 'active', (total + 7) // 8, checksums, alg))
+        c.execute('''INSERT OR REPLACE INTO transfer_stats
+                     (file_id, start_time, total_bytes, chunks_received, bytes_received, errors, avg_speed)
+                     VALUES (?, strftime('%Y-%m-%d %H:%M:%f', 'now'), ?, 0, 0, 0, 0)''',
+                  (file_id, size))
+    _chunk_handlers[file_id] = _make_chunk_handler(file_id, filename, size, chunk_size, total,
+                                                   bytes((total + 7) // 8), 0, alg)
+    emit_q.put_nowait(('manifest', {'file_id': file_id, 'filename': filename, 'size': size, 'total_chunks': total, 'priority': priority}))
     return jsonify({'status':'ok'})
 
+@app.route('/upload/checksums/<file_id>', methods=['POST'])
+def upload_checksums(file_id):
+    """Complete a manifest opened with defer_checksums: per-chunk digests in chunk_id order"""
+    data = request.get_json()
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('SELECT status, total_chunks, alg, merkle FROM manifests WHERE file_id=?', (file_id,))
+    row = c.fetchone()
+    if not row:
+        return jsonify({'error': 'Unknown file_id'}), 404
+    if row['status'] != 'active':
+        return jsonify({'error': f'Transfer not active (status: {row["status"]})'}), 409
+    try:
+        digests = [bytes.fromhex(checksum) for checksum in data['checksums']]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid checksums'}), 400
+    if len(digests) != row['total_chunks'] or any(len(d) != 32 for d in digests):
+        return jsonify({'error': f"Expected {row['total_chunks']} 32-byte checksums"}), 400
+    checksums = b''.join(digests)
+    merkle = HASH_ALGORITHMS[row['alg']](checksums).hexdigest()
+    if row['merkle'] is not None:
+        # A retried post is fine; a different list must not replace the one
+        # chunks may already have been assembled against
+        if not hmac.compare_digest(merkle, row['merkle']):
+            return jsonify({'error': 'Checksums do not match the manifest', 'merkle': row['merkle']}), 409
+        return jsonify({'status': 'ok', 'merkle': merkle})
+    with db_transaction(conn):
+        c.execute('UPDATE manifests SET checksums = ?, merkle = ? WHERE file_id = ?', (checksums, merkle, file_id))
+    return jsonify({'status': 'ok', 'merkle': merkle})
+
+# Chunk statements. Each is always executed with this exact text, so the
+# connection's statement cache hands back the compiled statement instead of
+# parsing the SQL again on every chunk.
+SQL_GET_MANIFEST = '''SELECT status, filename, size, chunk_size, total_chunks, received_chunks, recv_bitmap, alg
+                      FROM manifests WHERE file_id = ?'''
+SQL_COUNT_ERROR = 'UPDATE transfer_stats SET errors = errors + 1 WHERE file_id = ?'
+# A concurrent duplicate finds the bit set already and must not bump the
+# counter a second time
+SQL_MARK_CHUNK = '''UPDATE manifests
+                    SET recv_bitmap = set_bit(recv_bitmap, ?), received_chunks = received_chunks + 1
+                    WHERE file_id = ? AND NOT get_bit(recv_bitmap, ?)'''
+# avg_speed is computed from the row's own start_time so concurrent chunks
+# cannot race on it
+SQL_UPDATE_STATS = '''UPDATE transfer_stats
+                      SET bytes_received = bytes_received + ?,
+                          chunks_received = chunks_received + 1,
+                          last_activity = strftime('%Y-%m-%d %H:%M:%f', 'now'),
+                          avg_speed = COALESCE((bytes_received + ?) /
+                              NULLIF((julianday('now') - julianday(start_time)) * 86400, 0), 0)
+                      WHERE file_id = ?'''
+SQL_GET_RECEIVED = 'SELECT received_chunks FROM manifests WHERE file_id = ?'
+
+# Chunk handlers of active transfers, keyed by file_id. Each is specialized
+# for its transfer by _make_chunk_handler(); presence in this dict is what
+# makes a transfer accept chunks.
+_chunk_handlers = {}
+
+def _make_chunk_handler(file_id, filename, size, chunk_size, total, bitmap, received, alg):
+    """
+    Build the chunk handler of one active transfer. Everything fixed for the
+    transfer (container fd, chunk size and count, bound SQL parameters) is held
+    in the closure, so a chunk costs read, hash, pwrite and one bitmap UPDATE.
+    The handler returns (response_body, status, events) like _process_chunk().
+    """
+    container = _get_container(file_id)
+    new_hash = HASH_ALGORITHMS[alg]
+    last_len = size - chunk_size * (total - 1)
+    file_params = (file_id,)
+    # In-memory copy of recv_bitmap, only used to answer duplicates early;
+    # SQL_MARK_CHUNK still decides what counts as received
+    bits = bytearray(bitmap)
+    
+    def count_error(c):
+        c.execute(SQL_COUNT_ERROR, file_params)
+    
+    def handle(chunk_id, expected, stream, start_time):
+        nonlocal received
+        events = []
+        
+        if not 0 <= chunk_id < total:
+            return {'error': 'Invalid chunk_id for this file'}, 400, events
+        
+        # Check if chunk already received (idempotency)
+        if _get_bit(bits, chunk_id):
+            logger.info(f"Chunk {chunk_id} for {file_id} already received (duplicate)")
+            
+            # Still return success for idempotency, but don't reprocess
+            return {
+                'status': 'ok',
+                'received': received,
+                'total': total,
+                'duplicate': True
+            }, 200, events
+        
+        # Verify before writing: the container has no scratch space, so a corrupt
+        # retransmission must never overwrite a chunk another request has accepted
+        calculated, chunk_len, data = _read_chunk(stream, new_hash, chunk_size)
+        
+        try:
+            if chunk_len == 0:
+                return {'error': 'Empty chunk data'}, 400, events
+            
+            # Chunks are written at chunk_id * chunk_size, so one cut on any other
+            # grid would land over its neighbours in the container
+            if chunk_len != (chunk_size if chunk_id < total - 1 else last_len):
+                return {'error': f'Chunk {chunk_id} is {chunk_len} bytes, manifest expects '
+                                 f'{chunk_size if chunk_id < total - 1 else last_len}'}, 400, events
+            
+            if not hmac.compare_digest(calculated, expected):
+                logger.warning(f"Checksum mismatch for {file_id} chunk {chunk_id}: expected {expected.hex()}, got {calculated.hex()}")
+                
+                # Update error statistics
+                db_write(count_error)
+                
+                # Emit error to dashboard
+                events.append(('error', {
+                    'file_id': file_id,
+                    'chunk_id': chunk_id,
+                    'message': f'Checksum mismatch for chunk {chunk_id}'
+                }))
+                
+                return {
+                    'error': 'Checksum verification failed',
+                    'expected': expected.hex(),
+                    'received': calculated.hex()
+                }, 400, events
+            
+            # The transfer may have been assembled or re-initialized meanwhile
+            if not container.acquire():
+                return {'error': 'Transfer not active'}, 409, events
+            try:
+                _write_at(container.fd, data, chunk_id * chunk_size)
+            except OSError as e:
+                logger.error(f"Failed to write chunk {chunk_id} for {file_id}: {e}")
+                return {'error': 'Failed to write chunk to disk'}, 500, events
+            finally:
+                container.release()
+            
+            def mark_received(c):
+                # Mark chunk as received, then update transfer statistics
+                c.execute(SQL_MARK_CHUNK, (chunk_id, file_id, chunk_id))
+                if c.rowcount:
+                    c.execute(SQL_UPDATE_STATS, (chunk_len, chunk_len, file_id))
+                # Get current progress
+                c.execute(SQL_GET_RECEIVED, file_params)
+                return c.fetchone()['received_chunks']
+            
+            received_count = received = db_write(mark_received)
+            bits[chunk_id >> 3] |= 1 << (chunk_id & 7)
+            
+            # Calculate transfer speed for this chunk
+            chunk_time = time.time() - start_time
+            chunk_speed = chunk_len / chunk_time if chunk_time > 0 else 0
+            
+            logger.info(f"Received chunk {chunk_id}/{total} for {file_id} "
+                       f"({received_count}/{total} total, {chunk_len} bytes, "
+                       f"{chunk_speed:.2f} B/s)")
+            
+            # Emit progress to dashboard
+            events.append(('chunk', {
+                'file_id': file_id,
+                'chunk_id': chunk_id,
+                'received': received_count,
+                'total': total,
+                'filename': filename,
+                'chunk_size': chunk_len,
+                'speed': chunk_speed
+            }))
+            
+            # Check if transfer is complete
+            if received_count == total:
+                logger.info(f"All chunks received for {file_id}, ready for assembly")
+                events.append(('transfer_complete', {
+                    'file_id': file_id,
+                    'filename': filename
+                }))
+            
+            return {
+                'status': 'ok',
+                'received': received_count,
+                'total': total,
+                'speed': chunk_speed,
+                'progress': round((received_count / total) * 100, 2)
+            }, 200, events
+        finally:
+            # Spooled by _read_chunk(); the caller owns a seekable stream
+            if data is not stream:
+                data.close()
+    
+    return handle
+
+def _process_chunk(file_id, chunk_id, expected, stream, start_time):
+    """
+    Validate, store and record one uploaded chunk. Runs via _offload(), so it
+    returns (response_body, status, events) and leaves jsonify/emit to the caller.
+    """
+    handler = _chunk_handlers.get(file_id)
+    if handler is None:
+        # Not built yet in this process (e.g. after a restart)
+        c = get_db_connection().cursor()
+        c.execute(SQL_GET_MANIFEST, (file_id,))
+        manifest = c.fetchone()
+        
+        if not manifest:
+            return {'error': 'Unknown file_id'}, 404, []
+        
+        if manifest['status'] != 'active':
+            return {'error': f'Transfer not active (status: {manifest["status"]})'}, 409, []
+        
+        handler = _chunk_handlers.setdefault(file_id, _make_chunk_handler(
+            file_id, manifest['filename'], manifest['size'], manifest['chunk_size'], manifest['total_chunks'],
+            manifest['recv_bitmap'], manifest['received_chunks'], manifest['alg']))
+    return handler(chunk_id, expected, stream, start_time)
+
+def _process_batch(file_id, stream, start_time):
+    """
+    Store every record of a /upload/chunks_batch body via _process_chunk().
+    Chunks are stored independently, so the response carries one status per
+    chunk; only framing errors and an unknown or inactive transfer fail the
+    whole batch.
+    """
+    results = []
+    events = []
+    progress = {}
+    consumed = 0
+    while True:
+        header = _read_exact(stream, BATCH_RECORD.size)
+        if not header:
+            break
+        if len(header) < BATCH_RECORD.size:
+            return {'error': 'Truncated batch record header', 'results': results}, 400, events
+        
+        chunk_id, length, expected = BATCH_RECORD.unpack(header)
+        # Bounds the decoded size of a compressed batch too
+        consumed += BATCH_RECORD.size + length
+        if consumed > app.config['MAX_CONTENT_LENGTH']:
+            return {'error': 'Batch too large', 'results': results}, 413, events
+        
+        record = _RecordStream(stream, length)
+        body, status, chunk_events = _process_chunk(file_id, chunk_id, expected, record, start_time)
+        record.drain()
+        events.extend(chunk_events)
+        if status in (404, 409):
+            return body, status, events
+        
+        results.append(dict(body, chunk_id=chunk_id, code=status))
+        if status == 200:
+            progress = {'received': body['received'], 'total': body['total']}
+    
+    return dict(progress, status='ok', results=results), 200, events
+
 @app.route('/upload/chunk', methods=['POST'])
 def upload_chunk():
     """Upload a file chunk with enhanced validation and monitoring"""
@@ -104,7 +957,10 @@ def upload_chunk():
         except ValueError:
             return jsonify({'error': 'Invalid chunk_id format'}), 400
         
-        checksum = request.form['checksum']
+        try:
+            expected = bytes.fromhex(request.form['checksum'])
+        except ValueError:
+            return jsonify({'error': 'Invalid checksum format'}), 400
         
         # Validate chunk file
         if 'chunk' not in request.files:
@@ -114,184 +970,119 @@ def upload_chunk():
         if f.filename == '':
             return jsonify({'error': 'Empty chunk file'}), 400
         
-        # Read and validate chunk data
-        data = f.read()
-        if len(data) == 0:
-            return jsonify({'error': 'Empty chunk data'}), 400
-        
-        # Verify checksum
-        m = hashlib.sha256()
-        m.update(data)
-        calculated_checksum = m.hexdigest()
-        
-        if calculated_checksum != checksum:
-            logger.warning(f"Checksum mismatch for {file_id} chunk {chunk_id}: expected {checksum}, got {calculated_checksum}")
-            
-            # Update error statistics
-            transfer_stats[file_id]['errors'] += 1
-            
-            # Emit error to dashboard
-            socketio.emit('error', {
-                'file_id': file_id,
-                'chunk_id': chunk_id,
-                'message': f'Checksum mismatch for chunk {chunk_id}'
-            })
-            
-            return jsonify({
-                'error': 'Checksum verification failed',
-                'expected': checksum,
-                'received': calculated_checksum
-            }), 400
-        
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Verify file_id exists and is active
-        c.execute('SELECT status, filename, total_chunks FROM manifests WHERE file_id = ?', (file_id,))
-        manifest = c.fetchone()
-        
-        if not manifest:
-            return jsonify({'error': 'Unknown file_id'}), 404
-        
-        if manifest['status'] != 'active':
-            return jsonify({'error': f'Transfer not active (status: {manifest["status"]})'}), 409
-        
-        # Check if chunk already received (idempotency)
-        c.execute('SELECT received FROM chunks WHERE file_id = ? AND chunk_id = ?', (file_id, chunk_id))
-        chunk_status = c.fetchone()
-        
-        if not chunk_status:
-            return jsonify({'error': 'Invalid chunk_id for this file'}), 400
-        
-        if chunk_status['received'] == 1:
-            logger.info(f"Chunk {chunk_id} for {file_id} already received (duplicate)")
-            
-            # Still return success for idempotency, but don't reprocess
-            c.execute('SELECT COUNT(*) as received FROM chunks WHERE file_id = ? AND received = 1', (file_id,))
-            received_count = c.fetchone()['received']
-            
-            return jsonify({
-                'status': 'ok',
-                'received': received_count,
-                'total': manifest['total_chunks'],
-                'duplicate': True
-            })
-        
-        # Write chunk to disk
-        ch_dir = UPLOAD_DIR / file_id
-        ch_dir.mkdir(parents=True, exist_ok=True)
-        chunk_path = ch_dir / f'chunk_{chunk_id:06d}.bin'
+        return _chunk_response(_offload(_process_chunk, file_id, chunk_id, expected, f.stream, start_time))
+    
+    except sqlite3.Error as e:
+        logger.error(f"Database error in upload_chunk: {e}")
+        return jsonify({'error': 'Database error'}), 500
+    
+    except Exception as e:
+        logger.error(f"Unexpected error in upload_chunk: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/upload/chunk/<file_id>/<int:chunk_id>', methods=['PUT'])
+def upload_chunk_raw(file_id, chunk_id):
+    """Upload a chunk as a raw application/octet-stream body, read straight off the socket"""
+    start_time = time.time()
+    
+    try:
+        checksum = request.headers.get('X-Checksum')
+        if not checksum:
+            return jsonify({'error': 'Missing required header: X-Checksum'}), 400
         
         try:
-            with open(chunk_path, 'wb') as fh:
-                fh.write(data)
-        except IOError as e:
-            logger.error(f"Failed to write chunk {chunk_id} for {file_id}: {e}")
-            return jsonify({'error': 'Failed to write chunk to disk'}), 500
-        
-        # Mark chunk as received
-        c.execute('''UPDATE chunks 
-                     SET received = 1, received_at = ?, retry_count = retry_count + 1 
-                     WHERE file_id = ? AND chunk_id = ?''',
-                  (datetime.now(), file_id, chunk_id))
-        
-        # Update transfer statistics
-        transfer_stats[file_id]['last_activity'] = datetime.now()
-        transfer_stats[file_id]['bytes_received'] += len(data)
-        transfer_stats[file_id]['chunks_received'] += 1
-        
-        # Get current progress
-        c.execute('SELECT COUNT(*) as received FROM chunks WHERE file_id = ? AND received = 1', (file_id,))
-        received_count = c.fetchone()['received']
-        
-        # Update database statistics
-        elapsed_time = time.time() - transfer_stats[file_id]['start_time'].timestamp()
-        avg_speed = transfer_stats[file_id]['bytes_received'] / elapsed_time if elapsed_time > 0 else 0
-        
-        c.execute('''UPDATE transfer_stats 
-                     SET chunks_received = ?, avg_speed = ?, errors = ?
-                     WHERE file_id = ?''',
-                  (received_count, avg_speed, transfer_stats[file_id]['errors'], file_id))
-        
-        conn.commit()
-        
-        # Calculate transfer speed for this chunk
-        chunk_time = time.time() - start_time
-        chunk_speed = len(data) / chunk_time if chunk_time > 0 else 0
-        
-        logger.info(f"Received chunk {chunk_id}/{manifest['total_chunks']} for {file_id} "
-                   f"({received_count}/{manifest['total_chunks']} total, {len(data)} bytes, "
-                   f"{chunk_speed:.2f} B/s)")
-        
-        # Emit progress to dashboard
-        socketio.emit('chunk', {
-            'file_id': file_id,
-            'chunk_id': chunk_id,
-            'received': received_count,
-            'total': manifest['total_chunks'],
-            'filename': manifest['filename'],
-            'chunk_size': len(data),
-            'speed': chunk_speed
-        })
-        
-        # Check if transfer is complete
-        if received_count == manifest['total_chunks']:
-            logger.info(f"All chunks received for {file_id}, ready for assembly")
-            socketio.emit('transfer_complete', {
-                'file_id': file_id,
-                'filename': manifest['filename']
-            })
+            expected = bytes.fromhex(checksum)
+        except ValueError:
+            return jsonify({'error': 'Invalid checksum format'}), 400
         
-        return jsonify({
-            'status': 'ok',
-            'received': received_count,
-            'total': manifest['total_chunks'],
-            'speed': chunk_speed,
-            'progress': round((received_count / manifest['total_chunks']) * 100, 2)
-        })
+        encoding = request.headers.get('X-Encoding')
+        if encoding and encoding not in CHUNK_ENCODINGS:
+            return jsonify({'error': f'Unsupported X-Encoding: {encoding}'}), 415
         
+        with _request_body() as stream:
+            if encoding:
+                # Decoded as it is read, so the checksum and grid checks see the original chunk
+                stream = zstandard.ZstdDecompressor().stream_reader(stream)
+            return _chunk_response(_offload(_process_chunk, file_id, chunk_id, expected, stream, start_time))
+    
+    except CHUNK_DECODE_ERRORS as e:
+        logger.warning(f"Undecodable {encoding} body for {file_id} chunk {chunk_id}: {e}")
+        return jsonify({'error': f'Invalid {encoding} chunk body'}), 400
+    
     except sqlite3.Error as e:
-        logger.error(f"Database error in upload_chunk: {e}")
+        logger.error(f"Database error in upload_chunk_raw: {e}")
         return jsonify({'error': 'Database error'}), 500
     
     except Exception as e:
-        logger.error(f"Unexpected error in upload_chunk: {e}")
+        logger.error(f"Unexpected error in upload_chunk_raw: {e}")
         return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/upload/chunks_batch/<file_id>', methods=['PUT'])
+def upload_chunks_batch(file_id):
+    """Upload several chunks in one body of BATCH_RECORD-framed records"""
+    start_time = time.time()
     
-    finally:
-        if 'conn' in locals():
-            conn.close()
+    try:
+        encoding = request.headers.get('X-Encoding')
+        if encoding and encoding not in CHUNK_ENCODINGS:
+            return jsonify({'error': f'Unsupported X-Encoding: {encoding}'}), 415
+        
+        with _request_body() as stream:
+            if encoding:
+                stream = zstandard.ZstdDecompressor().stream_reader(stream)
+            return _chunk_response(_offload(_process_batch, file_id, stream, start_time))
+    
+    except CHUNK_DECODE_ERRORS as e:
+        logger.warning(f"Undecodable {encoding} batch body for {file_id}: {e}")
+        return jsonify({'error': f'Invalid {encoding} batch body'}), 400
+    
+    except sqlite3.Error as e:
+        logger.error(f"Database error in upload_chunks_batch: {e}")
+        return jsonify({'error': 'Database error'}), 500
+    
+    except Exception as e:
+        logger.error(f"Unexpected error in upload_chunks_batch: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def _chunk_response(result):
+    body, status, events = result
+    for event in events:
+        emit_q.put_nowait(event)
+    return jsonify(body), status
 
 @app.route('/upload/missing/<file_id>', methods=['GET'])
 def missing(file_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT chunk_id FROM chunks WHERE file_id=? AND received=0', (file_id,))
-    rows = c.fetchall()
-    conn.close()
-    missing = [r[0] for r in rows]
+    c.execute('SELECT recv_bitmap, total_chunks FROM manifests WHERE file_id=?', (file_id,))
+    row = c.fetchone()
+    missing = _missing_chunks(row['recv_bitmap'], row['total_chunks']) if row else []
     return jsonify({'missing': missing})
 
 @app.route('/assemble/<file_id>', methods=['POST'])
 def assemble(file_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT filename,total_chunks,chunk_size FROM manifests WHERE file_id=?', (file_id,))
+    c.execute('SELECT filename,total_chunks,received_chunks,recv_bitmap,merkle FROM manifests WHERE file_id=?', (file_id,))
     row = c.fetchone()
     if not row:
         return jsonify({'error':'unknown file id'}), 404
-    filename, total, chunk_size = row
-    ch_dir = UPLOAD_DIR / file_id
+    filename, total, received, bitmap, merkle = row
+    if received < total:
+        return jsonify({'error':f'missing chunk {_missing_chunks(bitmap, total)[0]}'}), 400
+    if merkle is None:
+        return jsonify({'error':'chunk checksums not received yet'}), 409
+    part_path = _container_path(file_id)
     out_path = UPLOAD_DIR / f'assembled_{filename}'
-    with open(out_path, 'wb') as out:
-        for i in range(total):
-            p = ch_dir / f'chunk_{i:06d}.bin'
-            if not p.exists():
-                return jsonify({'error':f'missing chunk {i}'}), 400
-            with open(p,'rb') as fh:
-                out.write(fh.read())
-    # verify full file hash if provided
-    socketio.emit('assembled', {'file_id':file_id, 'filename': filename})
+    if not part_path.exists():
+        return jsonify({'error':'no data to assemble'}), 404
+    # Chunks were written in place, so the container already is the file
+    _chunk_handlers.pop(file_id, None)
+    _close_container(file_id)
+    os.replace(part_path, out_path)
+    with db_transaction(conn):
+        c.execute("UPDATE manifests SET status='completed', completed_at=CURRENT_TIMESTAMP WHERE file_id=?", (file_id,))
+    emit_q.put_nowait(('assembled', {'file_id':file_id, 'filename': filename}))
     return jsonify({'status':'ok','path':str(out_path)})
 
 @app.route('/api/files', methods=['GET'])
@@ -322,10 +1113,6 @@ def list_files():
     except sqlite3.Error as e:
         logger.error(f"Database error in list_files: {e}")
         return jsonify({'error': 'Database error'}), 500
-    
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/files/<file_id>', methods=['GET'])
 def get_file_info(file_id):
@@ -334,7 +1121,8 @@ def get_file_info(file_id):
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute('''SELECT file_id, filename, size, status, created_at, completed_at, priority, total_chunks
+        c.execute('''SELECT file_id, filename, size, status, created_at, completed_at, priority, total_chunks,
+                            received_chunks, chunk_size, alg, merkle
                      FROM manifests 
                      WHERE file_id = ?''', (file_id,))
         
@@ -342,9 +1130,7 @@ def get_file_info(file_id):
         if not row:
             return jsonify({'error': 'File not found'}), 404
         
-        # Get chunk progress
-        c.execute('SELECT COUNT(*) as received FROM chunks WHERE file_id = ? AND received = 1', (file_id,))
-        received_chunks = c.fetchone()['received']
+        received_chunks = row['received_chunks']
         
         file_info = {
             'file_id': row['file_id'],
@@ -356,7 +1142,10 @@ def get_file_info(file_id):
             'priority': row['priority'],
             'total_chunks': row['total_chunks'],
             'received_chunks': received_chunks,
-            'progress': (received_chunks / row['total_chunks']) * 100 if row['total_chunks'] > 0 else 0
+            'progress': (received_chunks / row['total_chunks']) * 100 if row['total_chunks'] > 0 else 0,
+            'chunk_size': row['chunk_size'],
+            'alg': row['alg'],
+            'merkle': row['merkle']
         }
         
         return jsonify(file_info)
@@ -364,10 +1153,17 @@ def get_file_info(file_id):
     except sqlite3.Error as e:
         logger.error(f"Database error in get_file_info: {e}")
         return jsonify({'error': 'Database error'}), 500
-    
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+def _content_disposition(filename):
+    """
+    Build an attachment Content-Disposition, with an RFC 5987 name for non-ASCII filenames.
+    """
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        fallback = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii') or 'download'
+        return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
 
 @app.route('/download/<file_id>', methods=['GET'])
 def download_file(file_id):
@@ -397,11 +1193,21 @@ def download_file(file_id):
         
         logger.info(f"Serving download: {filename} to client")
         
+        if USE_XSENDFILE == 'nginx':
+            resp = make_response('')
+            resp.headers['X-Accel-Redirect'] = f"{XSENDFILE_PREFIX}/{quote(f'assembled_{filename}')}"
+            resp.headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            resp.headers['Content-Disposition'] = _content_disposition(filename)
+            return resp
+        
+        # conditional=True answers Range/If-Modified-Since and hands the file
+        # to the server's wsgi.file_wrapper (sendfile on gunicorn/uwsgi)
         return send_from_directory(
             str(UPLOAD_DIR),
             f'assembled_{filename}',
             as_attachment=True,
-            download_name=filename
+            download_name=filename,
+            conditional=True
         )
         
     except sqlite3.Error as e:
@@ -411,10 +1217,6 @@ def download_file(file_id):
     except Exception as e:
         logger.error(f"Error serving download: {e}")
         return jsonify({'error': 'Download failed'}), 500
-    
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -424,7 +1226,6 @@ def health_check():
         conn = get_db_connection()
         c = conn.cursor()
         c.execute('SELECT 1')
-        conn.close()
         
         return jsonify({
             'status': 'healthy',
@@ -461,96 +1262,3 @@ if __name__ == '__main__':
     except Exception as e:
         logger.error(f"Failed to start server: {e}")
         sys.exit(1)
-
-
-# Enhanced SQLite state management + migration
-def get_db_connection():
-    """
-    Open a SQLite connection with Row factory and timeout.
-    """
-    conn = sqlite3.connect(DB_PATH, timeout=30.0)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def _ensure_columns(cursor, table, required_defs):
-    """
-    Add missing columns to a table without dropping data.
-    required_defs: list of column definitions like "status TEXT DEFAULT 'active'"
-    """
-    cursor.execute(f"PRAGMA table_info({table})")
-    existing = {row[1] for row in cursor.fetchall()}
-    for col_def in required_defs:
-        name = col_def.split()[0]
-        if name not in existing:
-            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {col_def}")
-
-def init_db():
-    """
-    Create tables if needed and ensure columns used by routes exist.
-    """
-    conn = get_db_connection()
-    c = conn.cursor()
-    # Base tables
-    c.execute('''CREATE TABLE IF NOT EXISTS manifests (
-        file_id TEXT PRIMARY KEY,
-        filename TEXT NOT NULL,
-        size INTEGER NOT NULL,
-        chunk_size INTEGER NOT NULL,
-        total_chunks INTEGER NOT NULL
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS chunks (
-        file_id TEXT,
-        chunk_id INTEGER,
-        checksum TEXT NOT NULL,
-        received INTEGER DEFAULT 0,
-        PRIMARY KEY(file_id, chunk_id)
-    )''')
-    # Migrate extra columns used by current code
-    _ensure_columns(c, 'manifests', [
-        "merkle TEXT",
-        "priority TEXT DEFAULT 'normal'",
-        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
-        "completed_at TIMESTAMP",
-        "status TEXT DEFAULT 'active'"
-    ])
-    _ensure_columns(c, 'chunks', [
-        "received_at TIMESTAMP",
-        "retry_count INTEGER DEFAULT 0"
-    ])
-    # Stats table
-    c.execute('''CREATE TABLE IF NOT EXISTS transfer_stats (
-        file_id TEXT PRIMARY KEY,
-        start_time TIMESTAMP,
-        end_time TIMESTAMP,
-        total_bytes INTEGER,
-        chunks_received INTEGER,
-        errors INTEGER DEFAULT 0,
-        avg_speed REAL,
-        FOREIGN KEY(file_id) REFERENCES manifests(file_id)
-    )''')
-    # Indexes
-    c.execute('CREATE INDEX IF NOT EXISTS idx_chunks_file_received ON chunks(file_id, received)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_manifests_status ON manifests(status)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_manifests_priority ON manifests(priority)')
-    conn.commit()
-    conn.close()
-
-def cleanup_stale_transfers():
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        stale_time = datetime.now() - timedelta(hours=1)
-        c.execute('''UPDATE manifests
-                     SET status='stale'
-                     WHERE status='active' AND created_at < ?''', (stale_time,))
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Error cleaning up stale transfers: {e}")
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
-
-init_db()
-threading.Thread(target=lambda: (time.sleep(3600), cleanup_stale_transfers()), daemon=True).start()
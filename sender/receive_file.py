@@ -5,18 +5,28 @@ Downloads and verifies files from the coordinator server
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import sys
 import hashlib
 import argparse
 import logging
+import mmap
+import time
 from pathlib import Path
 import json
-from datetime import datetime
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 # Configuration
 SERVER = os.environ.get('SFTS_SERVER', 'http://127.0.0.1:5000')
 TIMEOUT = int(os.environ.get('SFTS_TIMEOUT', '30'))
+DOWNLOAD_BLOCK_SIZE = 256 * 1024
+PROGRESS_INTERVAL = 0.25  # seconds between progress updates
+HASH_ALG = os.environ.get('SFTS_HASH_ALG', 'blake3' if blake3 else 'sha256')
 
 # Setup logging
 logging.basicConfig(
@@ -29,10 +39,49 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# One keep-alive session for every request to the coordinator
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+def new_hasher(alg):
+    return blake3.blake3() if alg == 'blake3' else hashlib.sha256()
+
+class ChunkedDigest:
+    """
+    Hash a byte stream on the transfer's chunk grid and fold the chunk digests
+    into the coordinator's merkle root: H(digest_0 || digest_1 || ...)
+    """
+    def __init__(self, alg, chunk_size):
+        self.alg = alg
+        self.chunk_size = chunk_size
+        self.digests = []
+        self._current = new_hasher(alg)
+        self._filled = 0
+    
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.chunk_size - self._filled)
+            self._current.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.chunk_size:
+                self.digests.append(self._current.digest())
+                self._current = new_hasher(self.alg)
+                self._filled = 0
+    
+    def hexdigest(self):
+        digests = self.digests + ([self._current.digest()] if self._filled else [])
+        root = new_hasher(self.alg)
+        root.update(b''.join(digests))
+        return root.hexdigest()
+
 def list_available_files():
     """List all available files on the server"""
     try:
-        response = requests.get(f"{SERVER}/api/files", timeout=TIMEOUT)
+        response = session.get(f"{SERVER}/api/files", timeout=TIMEOUT)
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
@@ -43,7 +92,7 @@ def download_file(file_id, output_path=None):
     """Download a file from the server"""
     try:
         # Get file info first
-        response = requests.get(f"{SERVER}/api/files/{file_id}", timeout=TIMEOUT)
+        response = session.get(f"{SERVER}/api/files/{file_id}", timeout=TIMEOUT)
         response.raise_for_status()
         file_info = response.json()
         
@@ -63,36 +112,73 @@ def download_file(file_id, output_path=None):
         
         logger.info(f"📥 Downloading {filename} ({size:,} bytes) to {output_path}")
         
+        # Verify in the same pass as the download rather than re-reading the file
+        merkle = file_info.get('merkle')
+        alg = file_info.get('alg', 'sha256')
+        digest = None
+        if not merkle:
+            logger.warning("Server has no checksum for this file; skipping verification")
+        elif alg == 'blake3' and blake3 is None:
+            logger.warning("File was hashed with blake3, which is not installed; skipping verification")
+        else:
+            digest = ChunkedDigest(alg, file_info['chunk_size'])
+        
         # Download the file
-        response = requests.get(f"{SERVER}/download/{file_id}", stream=True, timeout=TIMEOUT)
+        response = session.get(f"{SERVER}/download/{file_id}", stream=True, timeout=TIMEOUT)
         response.raise_for_status()
         
         downloaded = 0
-        start_time = datetime.now()
+        start = time.monotonic()
+        last_print = 0.0
+        
+        def show_progress(now):
+            elapsed = now - start
+            speed = downloaded / elapsed if elapsed > 0 else 0
+            progress = (downloaded / size) * 100 if size > 0 else 0
+            
+            print(f"\r📊 Progress: {progress:.1f}% ({downloaded:,}/{size:,} bytes) "
+                  f"Speed: {speed/1024:.1f} KB/s", end='', flush=True)
         
         with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
+            # Reserve the whole file up front so it is written unfragmented
+            if size > 0:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except (AttributeError, OSError):
+                    f.truncate(size)
+            
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_BLOCK_SIZE):
                 if chunk:
+                    if digest is not None:
+                        digest.update(chunk)
                     f.write(chunk)
                     downloaded += len(chunk)
                     
-                    # Progress update every MB
-                    if downloaded % (1024 * 1024) == 0:
-                        elapsed = (datetime.now() - start_time).total_seconds()
-                        speed = downloaded / elapsed if elapsed > 0 else 0
-                        progress = (downloaded / size) * 100 if size > 0 else 0
-                        
-                        print(f"\r📊 Progress: {progress:.1f}% ({downloaded:,}/{size:,} bytes) "
-                              f"Speed: {speed/1024:.1f} KB/s", end='', flush=True)
+                    # Progress update at most every PROGRESS_INTERVAL
+                    now = time.monotonic()
+                    if now - last_print >= PROGRESS_INTERVAL:
+                        last_print = now
+                        show_progress(now)
+            
+            # Drop any preallocated tail the server never sent
+            f.truncate(downloaded)
         
+        # Always draw the final frame so a fast download ends at 100%
+        show_progress(time.monotonic())
         print()  # New line after progress
         
-        # Verify file size
-        actual_size = output_path.stat().st_size
-        if actual_size != size:
-            logger.error(f"Size mismatch: expected {size}, got {actual_size}")
+        # Verify file size; the file was preallocated, so count what arrived
+        if downloaded != size:
+            logger.error(f"Size mismatch: expected {size}, got {downloaded}")
             return False
         
+        if digest is not None:
+            calculated = digest.hexdigest()
+            if calculated != merkle:
+                logger.error(f"❌ Checksum mismatch: expected {merkle}, got {calculated}")
+                return False
+            logger.info(f"✅ File integrity verified ({alg})")
+        
         logger.info(f"✅ Download completed: {output_path}")
         return True
         
@@ -103,17 +189,22 @@ def download_file(file_id, output_path=None):
         logger.error(f"Unexpected error: {e}")
         return False
 
-def verify_file_integrity(file_path, expected_checksum=None):
-    """Verify file integrity using SHA-256"""
+def verify_file_integrity(file_path, expected_checksum=None, alg=HASH_ALG):
+    """Verify file integrity using SHA-256 or BLAKE3"""
     try:
-        logger.info(f"🔍 Verifying integrity of {file_path}")
+        logger.info(f"🔍 Verifying integrity of {file_path} ({alg})")
         
-        sha256_hash = hashlib.sha256()
+        if alg == 'blake3':
+            file_hash = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        else:
+            file_hash = hashlib.sha256()
         with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(chunk)
+            # Hash the whole file in one call over a read-only mapping
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    file_hash.update(mm)
         
-        calculated_checksum = sha256_hash.hexdigest()
+        calculated_checksum = file_hash.hexdigest()
         
         if expected_checksum:
             if calculated_checksum == expected_checksum:
@@ -131,6 +222,7 @@ def verify_file_integrity(file_path, expected_checksum=None):
         return False
 
 def main():
+    global SERVER
     parser = argparse.ArgumentParser(description='Smart File Transfer System - Receiver')
     parser.add_argument('--server', default=SERVER, help=f'Server URL (default: {SERVER})')
     parser.add_argument('--list', action='store_true', help='List available files')
@@ -138,6 +230,8 @@ def main():
     parser.add_argument('--output', '-o', help='Output file path')
     parser.add_argument('--verify', help='Verify integrity of local file')
     parser.add_argument('--checksum', help='Expected checksum for verification')
+    parser.add_argument('--alg', choices=['sha256', 'blake3'], default=HASH_ALG,
+                        help=f'Hash algorithm for verification (default: {HASH_ALG})')
     parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
     
     args = parser.parse_args()
@@ -146,7 +240,6 @@ def main():
         logging.getLogger().setLevel(logging.DEBUG)
     
     # Update global server URL
-    global SERVER
     SERVER = args.server
     
     if args.list:
@@ -185,7 +278,11 @@ def main():
             logger.error(f"File not found: {file_path}")
             sys.exit(1)
         
-        success = verify_file_integrity(file_path, args.checksum)
+        if args.alg == 'blake3' and blake3 is None:
+            logger.error("blake3 is not installed (pip install blake3)")
+            sys.exit(1)
+        
+        success = verify_file_integrity(file_path, args.checksum, args.alg)
         
         if not success:
             sys.exit(1)
@@ -1,10 +1,28 @@
 #!/usr/bin/env python3
-import requests, os, sys, hashlib, uuid, json, time, argparse, logging
+import requests, os, sys, hashlib, uuid, json, time, argparse, logging, socket
+import http.client
 from datetime import datetime, timedelta
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection
 import threading
+import mmap
+import queue
+import struct
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+from urllib.parse import urlsplit
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Configuration
 SERVER = os.environ.get('SFTS_SERVER', 'http://127.0.0.1:5000')
@@ -13,6 +31,24 @@ INITIAL_CHUNK_SIZE = int(os.environ.get('SFTS_CHUNK_SIZE', str(256 * 1024)))  #
 MIN_CHUNK_SIZE = 64 * 1024   # 64KB minimum
 MAX_CHUNK_SIZE = 10 * 1024 * 1024  # 10MB maximum
 TIMEOUT = int(os.environ.get('SFTS_TIMEOUT', '30'))
+STATE_DIR = Path(os.environ.get('SFTS_STATE_DIR', Path.home() / '.sfts' / 'state'))  # per-transfer checksum cache
+PARALLEL = int(os.environ.get('SFTS_PARALLEL', '8'))  # concurrent chunk uploads
+MAX_PARALLEL = 256  # ceiling for --parallel
+UPLOAD_THREAD_STACK = 512 * 1024  # upload workers only hash and do socket I/O; small stacks keep wide windows cheap
+# SO_SNDBUF/SO_RCVBUF for upload sockets; 0 leaves them to kernel autotuning,
+# which an explicit size switches off (and the kernel caps at wmem_max/rmem_max)
+SOCKET_BUFFER = int(os.environ.get('SFTS_SOCKET_BUFFER', '0'))
+HASH_ALG = os.environ.get('SFTS_HASH_ALG', 'blake3' if blake3 else 'sha256')
+BLAKE3_MT_THRESHOLD = 1024 * 1024  # BLAKE3 only gains from extra threads on inputs >= 1MB
+SPLIT_READAHEAD = 8 * 1024 * 1024  # split_file keeps this much of the file prefetched ahead of the hasher
+ZSTD_LEVEL = 3
+COMPRESS_PROBE_SIZE = 1024 * 1024  # bytes of the file sampled to decide on compression
+COMPRESS_MIN_RATIO = 0.9  # compress only if the probe shrinks below this fraction
+BATCH_CHUNK_LIMIT = 512 * 1024  # chunks smaller than this are uploaded in batches
+BATCH_BYTES = 8 * 1024 * 1024  # upper bound on the chunk data in one batch
+# Record header of a batch body: chunk_id, data length, raw digest; data follows
+BATCH_RECORD = struct.Struct('>II32s')
+HASH_WORKERS = int(os.environ.get('SFTS_HASH_WORKERS', str(os.cpu_count() or 1)))  # split_file hashing threads
 
 # Setup logging
 logging.basicConfig(
@@ -26,18 +62,39 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Network resilience setup
-def create_resilient_session():
+class TunedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets disable Nagle and optionally size their buffers"""
+    def init_poolmanager(self, *args, **kwargs):
+        options = list(HTTPConnection.default_socket_options)
+        if (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) not in options:
+            options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+        if SOCKET_BUFFER > 0:
+            options += [(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER),
+                        (socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)]
+        kwargs['socket_options'] = options
+        super().init_poolmanager(*args, **kwargs)
+
+def create_resilient_session(pool_size=PARALLEL):
     """Create a requests session with retry strategy and timeouts"""
     session = requests.Session()
     
-    retry_strategy = Retry(
+    retry_kwargs = dict(
         total=3,
         status_forcelist=[429, 500, 502, 503, 504],
-        method_whitelist=["HEAD", "GET", "OPTIONS", "POST"],
         backoff_factor=1
     )
+    methods = ["HEAD", "GET", "OPTIONS", "POST", "PUT"]
+    try:
+        retry_strategy = Retry(allowed_methods=methods, **retry_kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        retry_strategy = Retry(method_whitelist=methods, **retry_kwargs)
     
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    # One pooled connection per upload worker, so parallel chunks never queue
+    # for (or drop) connections; pool_block waits for a free keep-alive
+    # connection rather than opening a throwaway one
+    adapter = TunedHTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size,
+                               pool_maxsize=pool_size, pool_block=True)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     
@@ -46,83 +103,266 @@ def create_resilient_session():
 # Global session for connection reuse
 session = create_resilient_session()
 
-def sha256_bytes(b):
-    h = hashlib.sha256()
-    h.update(b)
-    return h.hexdigest()
+# Loopback fast path: when the coordinator is on this host, chunk bodies go
+# from the page cache to the socket with sendfile() instead of being copied
+# through user space. Set by main() to (source file, chunk_size).
+LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+sendfile_source = None
+_loopback = threading.local()  # one keep-alive http.client connection per upload worker
+
+class SendfileBody:
+    """An upload body of bytes parts and (offset, count) ranges of a file sent with sendfile()"""
+    def __init__(self, fileobj, parts):
+        self.fileobj = fileobj
+        self.parts = parts
+    
+    def __len__(self):
+        return sum(part[1] if isinstance(part, tuple) else len(part) for part in self.parts)
+
+class LoopbackResponse:
+    """The bits of a requests.Response that put_with_retries() uses"""
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+    
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+    
+    def json(self):
+        return json.loads(self.content)
+
+def loopback_put(url, body, headers):
+    """PUT a SendfileBody over this thread's keep-alive connection"""
+    u = urlsplit(url)
+    conn = getattr(_loopback, 'conn', None)
+    if conn is None:
+        conn = _loopback.conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=TIMEOUT)
+    try:
+        conn.putrequest('PUT', u.path)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.putheader('Content-Length', str(len(body)))
+        conn.endheaders()
+        for part in body.parts:
+            if isinstance(part, tuple):
+                offset, count = part
+                conn.sock.sendfile(body.fileobj, offset, count)
+            else:
+                conn.sock.sendall(part)
+        response = conn.getresponse()
+        content = response.read()
+    except Exception:
+        # http.client reconnects on the next request
+        conn.close()
+        raise
+    if response.will_close:
+        conn.close()
+    return LoopbackResponse(response.status, content)
+
+def hash_bytes(b, multithreaded=True):
+    """Hex digest of b using HASH_ALG"""
+    if HASH_ALG == 'blake3':
+        threads = blake3.blake3.AUTO if multithreaded and len(b) >= BLAKE3_MT_THRESHOLD else 1
+        return blake3.blake3(b, max_threads=threads).hexdigest()
+    return hashlib.sha256(b).hexdigest()
+
+def _hash_range(mm, mv, size, chunk_size, start_id, end_id, multithreaded, skip_ids=(), on_chunk=None):
+    """Checksums of chunks start_id..end_id-1 of a mapped file, in order; None for skip_ids"""
+    checksums = []
+    prefetch = hasattr(mmap, 'MADV_WILLNEED')
+    prefetched = 0
+    range_end = min(size, end_id * chunk_size)
+    for chunk_id, offset in enumerate(range(start_id * chunk_size, range_end, chunk_size), start_id):
+        if chunk_id in skip_ids:
+            checksums.append(None)
+            continue
+        # Queue disk reads one window ahead so hashing rarely waits on page
+        # faults; skipped chunks are never read (madvise needs page alignment)
+        prefetched = max(prefetched, offset // mmap.PAGESIZE * mmap.PAGESIZE)
+        while prefetch and prefetched < min(range_end, offset + chunk_size + SPLIT_READAHEAD):
+            mm.madvise(mmap.MADV_WILLNEED, prefetched, min(SPLIT_READAHEAD, range_end - prefetched))
+            prefetched += SPLIT_READAHEAD
+        with mv[offset:offset + chunk_size] as data:
+            checksums.append(hash_bytes(data, multithreaded))
+        if on_chunk is not None and on_chunk(chunk_id, checksums[-1]) is False:
+            break
+    return checksums
+
+_zstd = threading.local()  # ZstdCompressor is not thread-safe; one per upload worker
+
+def compress_bytes(b):
+    """zstd-compress b at ZSTD_LEVEL"""
+    cctx = getattr(_zstd, 'cctx', None)
+    if cctx is None:
+        cctx = _zstd.cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return cctx.compress(b)
+
+def is_compressible(sample):
+    """Whether zstd is available and meaningfully shrinks a sample of the file"""
+    if zstandard is None or not sample:
+        return False
+    return len(compress_bytes(sample)) < len(sample) * COMPRESS_MIN_RATIO
 
-def split_file(path, chunk_size):
+def split_file(path, chunk_size, skip_ids=(), on_chunk=None):
+    """
+    Split a file into chunk metadata; returns (chunks, checksums indexed by
+    chunk_id). Chunks in skip_ids (already held by the coordinator) are not
+    read or hashed, and their checksum is None. on_chunk(chunk_id, checksum)
+    is called from the hashing threads as each chunk is done, in no particular
+    order across shards; returning False stops hashing early.
+    """
     size = os.path.getsize(path)
-    chunks = []
-    with open(path,'rb') as fh:
-        idx = 0
-        while True:
-            data = fh.read(chunk_size)
-            if not data:
-                break
-            checksum = sha256_bytes(data)
-            chunks.append({'chunk_id': idx, 'size': len(data), 'checksum': checksum})
-            idx += 1
-    return chunks
+    if size == 0:
+        return [], []
+    total = (size + chunk_size - 1) // chunk_size
+    workers = max(1, min(HASH_WORKERS, total))
+    # Hash straight out of a read-only mapping; chunks are slices, not copies.
+    # Both hashlib and blake3 release the GIL while hashing, so threads over
+    # disjoint chunk ranges scale across cores without any IPC.
+    with open(path,'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as mv:
+            if workers == 1:
+                checksums = _hash_range(mm, mv, size, chunk_size, 0, total, True, skip_ids, on_chunk)
+            else:
+                bounds = [total * i // workers for i in range(workers + 1)]
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    # Cores are already busy with one shard each, so hash every chunk single-threaded
+                    shards = pool.map(lambda i: _hash_range(mm, mv, size, chunk_size, bounds[i], bounds[i + 1],
+                                                            False, skip_ids, on_chunk),
+                                      range(workers))
+                    checksums = [c for shard in shards for c in shard]
+    chunks = [{'chunk_id': idx, 'size': min(chunk_size, size - idx * chunk_size), 'checksum': checksum}
+              for idx, checksum in enumerate(checksums)]
+    return chunks, checksums
 
 def send_manifest(file_id, filename, size, chunk_size, chunks, priority):
+    """Open the transfer; with chunks=None the checksums follow later via send_checksums()"""
     payload = {
         'file_id': file_id,
         'filename': os.path.basename(filename),
         'size': size,
         'chunk_size': chunk_size,
-        'chunks': chunks,
-        'priority': priority
+        'priority': priority,
+        'alg': HASH_ALG
     }
-    r = requests.post(SERVER + '/upload/init', json=payload)
+    if chunks is None:
+        payload['defer_checksums'] = True
+    else:
+        payload['chunks'] = chunks
+    r = session.post(SERVER + '/upload/init', json=payload, timeout=TIMEOUT)
     r.raise_for_status()
     return r.json()
 
+def send_checksums(file_id, checksums):
+    """Complete a deferred manifest with every chunk's checksum, in chunk_id order"""
+    r = session.post(SERVER + f'/upload/checksums/{file_id}', json={'checksums': checksums}, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.json()
+
+def resume_manifest(file_id, filename, size, chunk_size, priority):
+    """Ask the server whether it holds this file: its resume info, {'status': 'completed'} if already sent, else None"""
+    payload = {
+        'file_id': file_id,
+        'filename': os.path.basename(filename),
+        'size': size,
+        'chunk_size': chunk_size,
+        'priority': priority,
+        'alg': HASH_ALG,
+        'resume': True
+    }
+    r = session.post(SERVER + '/upload/init', json=payload, timeout=TIMEOUT)
+    r.raise_for_status()
+    result = r.json()
+    return result if result.get('status') in ('resumed', 'completed') else None
+
+def transfer_id(path, chunk_size):
+    """
+    Stable file_id for sending this file (as it is now) from this host, so a
+    rerun resumes. Keyed by inode rather than path, so renames keep the id.
+    """
+    st = path.stat()
+    key = f"{socket.gethostname()}:{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{chunk_size}:{HASH_ALG}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+def load_state(file_id):
+    """Checksums cached by an earlier run of this transfer, or None"""
+    try:
+        with open(STATE_DIR / f"{file_id}.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_state(file_id, state):
+    """Cache a transfer's checksums so a rerun need not hash the file again; best effort"""
+    try:
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = STATE_DIR / f"{file_id}.json.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, STATE_DIR / f"{file_id}.json")
+    except OSError as e:
+        logger.debug(f"Could not save transfer state: {e}")
+
+def clear_state(file_id):
+    try:
+        os.remove(STATE_DIR / f"{file_id}.json")
+    except OSError:
+        pass
+
 class NetworkMonitor:
-    """Monitor network quality and adapt transfer parameters"""
+    """Track upload outcomes; the success rate drives adaptive_window()"""
     def __init__(self):
         self.success_count = 0
         self.failure_count = 0
-        self.recent_speeds = []
-        self.last_speed_check = time.time()
+        self._lock = threading.Lock()  # updated from all upload workers
         
-    def record_success(self, bytes_sent, duration):
-        self.success_count += 1
-        speed = bytes_sent / duration if duration > 0 else 0
-        self.recent_speeds.append(speed)
-        if len(self.recent_speeds) > 10:
-            self.recent_speeds.pop(0)
+    def record_success(self):
+        with self._lock:
+            self.success_count += 1
     
     def record_failure(self):
-        self.failure_count += 1
-    
-    def get_avg_speed(self):
-        return sum(self.recent_speeds) / len(self.recent_speeds) if self.recent_speeds else 0
+        with self._lock:
+            self.failure_count += 1
     
     def get_success_rate(self):
         total = self.success_count + self.failure_count
         return self.success_count / total if total > 0 else 1.0
-    
-    def should_reduce_chunk_size(self):
-        return self.get_success_rate() < 0.8 and self.failure_count > 3
 
 network_monitor = NetworkMonitor()
 
-def adaptive_chunk_size(current_size, success_rate, avg_speed):
-    """Dynamically adjust chunk size based on network conditions"""
-    if success_rate > 0.95 and avg_speed > 1024 * 1024:  # > 1MB/s
-        # Network is good, try larger chunks
-        new_size = min(current_size * 1.2, MAX_CHUNK_SIZE)
-    elif success_rate < 0.8 or avg_speed < 100 * 1024:  # < 100KB/s
-        # Network is poor, use smaller chunks
-        new_size = max(current_size * 0.7, MIN_CHUNK_SIZE)
+def adaptive_window(current_window, max_window, success_rate):
+    """Adjust the number of in-flight chunks based on network conditions.
+
+    The chunk grid is fixed by the manifest, so adaptation only changes how
+    many uploads are issued at once, never which bytes make up a chunk.
+    """
+    if success_rate < 0.8:
+        # Network is poor, back off hard
+        new_window = max(1, current_window // 2)
+    elif success_rate > 0.95:
+        # Network is good, open the window back up gradually
+        new_window = min(current_window + 1, max_window)
     else:
-        new_size = current_size
+        new_window = current_window
     
-    return int(new_size)
+    return new_window
 
-def upload_chunk(file_id, chunk_id, data, checksum, max_retries=None):
+def upload_chunk(file_id, chunk_id, data, checksum, max_retries=None, encoding=None):
     """Upload a chunk with adaptive retry logic and network monitoring"""
+    headers = {'X-Checksum': checksum, 'Content-Type': 'application/octet-stream'}
+    if encoding:
+        # The checksum is of the decoded chunk; the coordinator decodes before verifying
+        headers['X-Encoding'] = encoding
+    
+    # Raw body, no multipart framing: the mmap slice goes out as-is
+    return put_with_retries(f"{SERVER}/upload/chunk/{file_id}/{chunk_id}", data, headers,
+                            f"chunk {chunk_id}", max_retries)
+
+def put_with_retries(url, data, headers, what, max_retries=None):
+    """PUT one upload body with adaptive retry logic and network monitoring; `what` names it in logs"""
     if max_retries is None:
         max_retries = MAX_RETRIES
     
@@ -132,31 +372,22 @@ def upload_chunk(file_id, chunk_id, data, checksum, max_retries=None):
         start_time = time.time()
         
         try:
-            files = {'chunk': ('chunk', data)}
-            form_data = {
-                'file_id': file_id,
-                'chunk_id': str(chunk_id),
-                'checksum': checksum
-            }
-            
-            logger.debug(f"Uploading chunk {chunk_id}, attempt {attempt}/{max_retries} ({chunk_size} bytes)")
+            logger.debug(f"Uploading {what}, attempt {attempt}/{max_retries} ({chunk_size} bytes)")
             
-            response = session.post(
-                f"{SERVER}/upload/chunk",
-                data=form_data,
-                files=files,
-                timeout=TIMEOUT
-            )
+            if isinstance(data, SendfileBody):
+                response = loopback_put(url, data, headers)
+            else:
+                response = session.put(url, data=data, headers=headers, timeout=TIMEOUT)
             
             duration = time.time() - start_time
             
             if response.status_code == 200:
-                network_monitor.record_success(chunk_size, duration)
+                network_monitor.record_success()
                 
                 result = response.json()
                 speed = chunk_size / duration if duration > 0 else 0
                 
-                logger.info(f"✅ Chunk {chunk_id} uploaded successfully "
+                logger.info(f"✅ {what.capitalize()} uploaded successfully "
                            f"({chunk_size} bytes in {duration:.2f}s, {speed:.0f} B/s) "
                            f"- Progress: {result.get('received', 0)}/{result.get('total', 0)}")
                 
@@ -164,7 +395,7 @@ def upload_chunk(file_id, chunk_id, data, checksum, max_retries=None):
             
             else:
                 network_monitor.record_failure()
-                error_msg = f"Server rejected chunk {chunk_id} (HTTP {response.status_code})"
+                error_msg = f"Server rejected {what} (HTTP {response.status_code})"
                 
                 try:
                     error_detail = response.json().get('error', response.text)
@@ -176,20 +407,20 @@ def upload_chunk(file_id, chunk_id, data, checksum, max_retries=None):
                 
                 # Don't retry on certain errors
                 if response.status_code in [400, 404, 409]:
-                    logger.error(f"Permanent error for chunk {chunk_id}, not retrying")
+                    logger.error(f"Permanent error for {what}, not retrying")
                     return False, {'error': error_msg}
         
         except requests.exceptions.Timeout:
             network_monitor.record_failure()
-            logger.warning(f"Timeout uploading chunk {chunk_id}, attempt {attempt}/{max_retries}")
+            logger.warning(f"Timeout uploading {what}, attempt {attempt}/{max_retries}")
         
         except requests.exceptions.ConnectionError as e:
             network_monitor.record_failure()
-            logger.warning(f"Connection error uploading chunk {chunk_id}, attempt {attempt}/{max_retries}: {e}")
+            logger.warning(f"Connection error uploading {what}, attempt {attempt}/{max_retries}: {e}")
         
         except Exception as e:
             network_monitor.record_failure()
-            logger.error(f"Unexpected error uploading chunk {chunk_id}, attempt {attempt}/{max_retries}: {e}")
+            logger.error(f"Unexpected error uploading {what}, attempt {attempt}/{max_retries}: {e}")
         
         # Adaptive backoff based on network conditions
         if attempt < max_retries:
@@ -201,26 +432,87 @@ def upload_chunk(file_id, chunk_id, data, checksum, max_retries=None):
                 # Good network, shorter backoff
                 backoff = min(0.5 * attempt, 5)
             
-            logger.info(f"Retrying chunk {chunk_id} in {backoff:.1f}s...")
+            logger.info(f"Retrying {what} in {backoff:.1f}s...")
             time.sleep(backoff)
     
-    logger.error(f"❌ Failed to upload chunk {chunk_id} after {max_retries} attempts")
+    logger.error(f"❌ Failed to upload {what} after {max_retries} attempts")
     return False, {'error': f'Failed after {max_retries} attempts'}
 
+def send_chunk(file_id, chunk_id, data, checksum=None, max_retries=None, compress=False):
+    """Upload one chunk, hashing it first if no checksum is known; runs on an upload worker thread"""
+    if checksum is None:
+        checksum = hash_bytes(data)
+    if compress:
+        # Compressed once, reused by every retry; chunks that don't shrink go raw
+        payload = compress_bytes(data)
+        if len(payload) < len(data):
+            return upload_chunk(file_id, chunk_id, payload, checksum, max_retries, encoding='zstd')
+    if sendfile_source is not None:
+        fileobj, chunk_size = sendfile_source
+        data = SendfileBody(fileobj, [(chunk_id * chunk_size, len(data))])
+    return upload_chunk(file_id, chunk_id, data, checksum, max_retries)
+
+def send_batch(file_id, chunks, max_retries=None, compress=False):
+    """
+    Upload several (chunk_id, data, checksum) chunks in one BATCH_RECORD-framed
+    PUT; runs on an upload worker thread. Returns one (success, result) per chunk.
+    """
+    records = []
+    for chunk_id, data, checksum in chunks:
+        if checksum is None:
+            checksum = hash_bytes(data)
+        records.append((BATCH_RECORD.pack(chunk_id, len(data), bytes.fromhex(checksum)), chunk_id, data))
+    headers = {'Content-Type': 'application/octet-stream'}
+    body = None
+    if compress:
+        raw = b''.join(part for header, _, data in records for part in (header, data))
+        payload = compress_bytes(raw)
+        if len(payload) < len(raw):
+            body = payload
+            headers['X-Encoding'] = 'zstd'
+    if body is None:
+        if sendfile_source is not None:
+            # Record headers from memory, chunk data straight from the file
+            fileobj, chunk_size = sendfile_source
+            body = SendfileBody(fileobj, [part for header, chunk_id, data in records
+                                          for part in (header, (chunk_id * chunk_size, len(data)))])
+        else:
+            body = b''.join(part for header, _, data in records for part in (header, data))
+    
+    what = f"batch of {len(chunks)} chunks ({chunks[0][0]}-{chunks[-1][0]})"
+    success, result = put_with_retries(f"{SERVER}/upload/chunks_batch/{file_id}", body, headers, what, max_retries)
+    if not success:
+        return [(False, result)] * len(chunks)
+    return [(r.get('code') == 200, r) for r in result.get('results', [])]
+
 def get_missing(file_id):
-    r = requests.get(SERVER + f'/upload/missing/{file_id}')
+    r = session.get(SERVER + f'/upload/missing/{file_id}', timeout=TIMEOUT)
     r.raise_for_status()
     return r.json().get('missing', [])
 
 def assemble(file_id):
-    r = requests.post(SERVER + f'/assemble/{file_id}')
+    r = session.post(SERVER + f'/assemble/{file_id}', timeout=TIMEOUT)
     return r.json()
 
+PROGRESS_INTERVAL = 0.25  # seconds between progress bar refreshes
+BAR_LENGTH = 40
+BARS = ['█' * i + '░' * (BAR_LENGTH - i) for i in range(BAR_LENGTH + 1)]
+FMT = "\r[{bar}] {pct:.1%} ({cur}/{tot}) | {spd} | ETA: {eta}".format
+_last_progress = 0.0
+_progress_open = False  # a frame is on the current line, unterminated
+
 def print_progress(current, total, start_time, bytes_transferred):
-    """Print a nice progress bar with statistics"""
+    """Print a nice progress bar with statistics, at most every PROGRESS_INTERVAL"""
+    global _last_progress, _progress_open
     if total == 0:
         return
     
+    # Always draw the final frame so the bar ends at 100%
+    now = time.monotonic()
+    if now - _last_progress < PROGRESS_INTERVAL and current < total:
+        return
+    _last_progress = now
+    
     progress = current / total
     elapsed = time.time() - start_time
     
@@ -233,9 +525,7 @@ def print_progress(current, total, start_time, bytes_transferred):
         eta = 0
     
     # Progress bar
-    bar_length = 40
-    filled_length = int(bar_length * progress)
-    bar = '█' * filled_length + '░' * (bar_length - filled_length)
+    bar = BARS[int(BAR_LENGTH * progress)]
     
     # Format speed
     if speed > 1024 * 1024:
@@ -253,20 +543,34 @@ def print_progress(current, total, start_time, bytes_transferred):
     else:
         eta_str = f"{eta:.0f}s"
     
-    print(f"\r[{bar}] {progress:.1%} ({current}/{total}) | {speed_str} | ETA: {eta_str}", end='', flush=True)
+    sys.stdout.write(FMT(bar=bar, pct=progress, cur=current, tot=total, spd=speed_str, eta=eta_str))
+    sys.stdout.flush()
+    _progress_open = True
+
+def end_progress():
+    """Move off the progress bar line, if one is drawn, so log output starts on a fresh line"""
+    global _progress_open
+    if _progress_open:
+        print()
+        _progress_open = False
 
 def main():
     """Enhanced main function with comprehensive error handling and adaptive features"""
+    global SERVER, session, sendfile_source, HASH_ALG
     ap = argparse.ArgumentParser(description='Smart File Transfer System - Sender')
     ap.add_argument('file', help='File to send')
     ap.add_argument('--chunk-size', type=int, default=INITIAL_CHUNK_SIZE, 
-                   help=f'Initial chunk size in bytes (default: {INITIAL_CHUNK_SIZE})')
+                   help=f'Chunk size in bytes (default: {INITIAL_CHUNK_SIZE})')
     ap.add_argument('--priority', choices=['high', 'normal', 'low'], default='normal',
                    help='Transfer priority (default: normal)')
     ap.add_argument('--adaptive', action='store_true', default=True,
-                   help='Enable adaptive chunk sizing (default: enabled)')
+                   help='Adapt the upload window to network conditions (default: enabled)')
     ap.add_argument('--max-retries', type=int, default=MAX_RETRIES,
                    help=f'Maximum retries per chunk (default: {MAX_RETRIES})')
+    ap.add_argument('--parallel', type=int, default=PARALLEL,
+                   help=f'Concurrent chunk uploads (default: {PARALLEL})')
+    ap.add_argument('--compress', choices=['auto', 'on', 'off'], default='auto',
+                   help='zstd-compress chunks: auto (compressible files, not to a loopback server), on, off (default: auto)')
     ap.add_argument('--server', default=SERVER,
                    help=f'Server URL (default: {SERVER})')
     ap.add_argument('--verbose', '-v', action='store_true',
@@ -292,105 +596,257 @@ def main():
         logger.error("Cannot send empty file")
         sys.exit(1)
     
+    if HASH_ALG not in ('sha256', 'blake3') or (HASH_ALG == 'blake3' and blake3 is None):
+        logger.error(f"Hash algorithm not available: {HASH_ALG} (install blake3 or set SFTS_HASH_ALG=sha256)")
+        sys.exit(1)
+    
+    if not MIN_CHUNK_SIZE <= args.chunk_size <= MAX_CHUNK_SIZE:
+        logger.error(f"--chunk-size must be between {MIN_CHUNK_SIZE:,} and {MAX_CHUNK_SIZE:,} bytes")
+        sys.exit(1)
+    
+    if not 1 <= args.parallel <= MAX_PARALLEL:
+        logger.error(f"--parallel must be between 1 and {MAX_PARALLEL}")
+        sys.exit(1)
+    
+    if args.compress == 'on' and zstandard is None:
+        logger.error("--compress on needs the zstandard package (pip install zstandard)")
+        sys.exit(1)
+    
     # Update global server URL
-    global SERVER
     SERVER = args.server
+    session = create_resilient_session(args.parallel)
+    # Upload worker threads pick up the stack size in force when they start
+    threading.stack_size(UPLOAD_THREAD_STACK)
     
     logger.info(f"🚀 Starting transfer: {path.name} ({size:,} bytes)")
     logger.info(f"📡 Server: {SERVER}")
     logger.info(f"⚡ Priority: {args.priority}")
-    logger.info(f"📦 Initial chunk size: {args.chunk_size:,} bytes")
+    logger.info(f"🔀 Parallel uploads: {args.parallel}")
+    logger.info(f"📦 Chunk size: {args.chunk_size:,} bytes")
+    logger.info(f"🔐 Checksums: {HASH_ALG}")
     
-    file_id = str(uuid.uuid4())
-    current_chunk_size = args.chunk_size
+    # Frozen for the whole transfer: the manifest's chunk grid never changes
+    chunk_size = args.chunk_size
+    file_id = transfer_id(path, chunk_size)
+    window = args.parallel
+    # Small chunks travel several to a request, so per-request overhead is paid per batch
+    batch_size = max(1, BATCH_BYTES // chunk_size) if chunk_size < BATCH_CHUNK_LIMIT else 1
     start_time = time.time()
     total_bytes_transferred = 0
+    stop_hashing = threading.Event()
     
     try:
-        # Initial file splitting
-        chunks_meta = split_file(str(path), current_chunk_size)
-        logger.info(f"📋 File split into {len(chunks_meta)} chunks")
+        # Map the file once for the whole transfer; each upload is a slice of it.
+        # Not closed explicitly: slices may still be alive when we exit.
+        fh = open(path, 'rb')
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_RANDOM'):
+            mm.madvise(mmap.MADV_RANDOM)
+        file_view = memoryview(mm)
         
-        # Send manifest
-        logger.info("📤 Sending manifest to server...")
-        manifest_result = send_manifest(file_id, str(path), size, current_chunk_size, chunks_meta, args.priority)
+        if urlsplit(SERVER).scheme == 'http' and urlsplit(SERVER).hostname in LOOPBACK_HOSTS and hasattr(os, 'sendfile'):
+            sendfile_source = (fh, chunk_size)
+            logger.info("🔁 Loopback server: sending chunk data with sendfile()")
         
-        if manifest_result.get('status') == 'resumed':
-            logger.info(f"🔄 Resuming transfer: {manifest_result.get('received_chunks', 0)} chunks already received")
+        # Chunks the server already verified on an earlier run are not hashed
+        # again, and with a cached checksum list nothing is
+        try:
+            resumed = resume_manifest(file_id, str(path), size, chunk_size, args.priority)
+        except requests.HTTPError as e:
+            # A coordinator without blake3 rejects it, but every one takes sha256
+            if (HASH_ALG == 'sha256' or e.response.status_code != 400 or
+                    'Unsupported hash algorithm' not in e.response.text):
+                raise
+            logger.warning(f"⚠️  Server does not support {HASH_ALG} checksums; falling back to sha256")
+            HASH_ALG = 'sha256'
+            file_id = transfer_id(path, chunk_size)
+            resumed = resume_manifest(file_id, str(path), size, chunk_size, args.priority)
+        if resumed and resumed['status'] == 'completed':
+            clear_state(file_id)
+            logger.info("✅ This file was already transferred to the server; nothing to send")
+            return
+        received = set(resumed['received_chunk_ids']) if resumed else set()
+        if resumed:
+            logger.info(f"🔄 Resuming transfer: {len(received)} chunks already received")
+        # A deferred manifest needs every checksum, received chunks included
+        post_checksums = resumed is None or resumed.get('checksums_pending', False)
+        
+        # Probe the start of the file once; already-compressed formats stay raw.
+        # Compressed chunks can't go out with sendfile(), and a loopback link
+        # gains nothing from the smaller body, so auto leaves them raw there
+        if args.compress == 'auto':
+            compress = sendfile_source is None and is_compressible(file_view[:COMPRESS_PROBE_SIZE])
+        else:
+            compress = args.compress == 'on'
+        if compress:
+            logger.info(f"🗜️  Compressing chunks with zstd (level {ZSTD_LEVEL})")
         
-        # Main upload loop with adaptive chunk sizing
+        # Send manifest without checksums, so uploads start while the file is
+        # still being hashed; a resumed transfer keeps the one the server has
+        total_chunks = (size + chunk_size - 1) // chunk_size
+        if resumed is None:
+            logger.info("📤 Sending manifest to server...")
+            send_manifest(file_id, str(path), size, chunk_size, None, args.priority)
+        
+        # Pipeline hashing with uploading: split_file's threads hand each hashed
+        # chunk id to the upload loop through a bounded queue, so hashing runs
+        # at most a couple of windows ahead of the network
+        checksums_by_id = [None] * total_chunks
+        state = load_state(file_id) if resumed else None
+        cached = state is not None and len(state.get('checksums', ())) == total_chunks
+        if cached:
+            checksums_by_id = state['checksums']
+            logger.info("📋 Using cached chunk checksums")
+        hashed = queue.Queue(maxsize=2 * args.parallel * batch_size)
+        
+        def offer(item):
+            while not stop_hashing.is_set():
+                try:
+                    hashed.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def on_hashed(chunk_id, checksum):
+            checksums_by_id[chunk_id] = checksum
+            return chunk_id in received or offer(chunk_id)
+        
+        def hash_file():
+            try:
+                if cached:
+                    for chunk_id in range(total_chunks):
+                        if chunk_id not in received and not offer(chunk_id):
+                            break
+                    return
+                split_file(str(path), chunk_size, set() if post_checksums else received, on_hashed)
+                if None not in checksums_by_id:
+                    save_state(file_id, {'filename': path.name, 'size': size, 'chunk_size': chunk_size,
+                                         'alg': HASH_ALG, 'checksums': checksums_by_id})
+            finally:
+                offer(None)  # end of the first round
+        
+        hash_pool = ThreadPoolExecutor(max_workers=1)
+        hashing = hash_pool.submit(hash_file)
+        hash_pool.shutdown(wait=False)
+        if not cached:
+            logger.info(f"📋 Hashing {total_chunks} chunks while uploading")
+        
+        # Main upload loop with an adaptive upload window
         retry_count = 0
         max_consecutive_failures = 5
         
+        # The first round takes chunks as they are hashed; after that each PUT
+        # response is the ACK/NACK for its chunk
+        completed_chunks = len(received)
+        pending_ids = iter(hashed.get, None)
+        missing = None
+        
         while True:
-            missing = get_missing(file_id)
-            if not missing:
-                break
+            if missing is not None:
+                logger.info(f"📊 Missing chunks: {len(missing)}")
+                pending_ids = iter(missing)
             
-            logger.info(f"📊 Missing chunks: {len(missing)}")
-            
-            # Adaptive chunk sizing based on network conditions
-            if args.adaptive and len(missing) > 1:
+            # Adapt concurrency (not chunk size) to network conditions, so
+            # already-received chunks and precomputed checksums stay valid
+            if args.adaptive and missing is not None and len(missing) > 1:
                 success_rate = network_monitor.get_success_rate()
-                avg_speed = network_monitor.get_avg_speed()
-                new_chunk_size = adaptive_chunk_size(current_chunk_size, success_rate, avg_speed)
+                new_window = adaptive_window(window, args.parallel, success_rate)
                 
-                if new_chunk_size != current_chunk_size:
-                    logger.info(f"🔧 Adapting chunk size: {current_chunk_size:,} → {new_chunk_size:,} bytes "
-                               f"(success rate: {success_rate:.1%}, avg speed: {avg_speed:.0f} B/s)")
-                    current_chunk_size = new_chunk_size
-                    
-                    # Re-split file with new chunk size if significantly different
-                    if abs(new_chunk_size - args.chunk_size) > args.chunk_size * 0.5:
-                        chunks_meta = split_file(str(path), current_chunk_size)
-                        send_manifest(file_id, str(path), size, current_chunk_size, chunks_meta, args.priority)
-                        continue
+                if new_window != window:
+                    logger.info(f"🔧 Adapting upload window: {window} → {new_window} "
+                               f"(success rate: {success_rate:.1%})")
+                    window = new_window
             
             consecutive_failures = 0
             
-            with open(path, 'rb') as fh:
-                for i, chunk_id in enumerate(missing):
-                    # Calculate chunk position and size for current chunk size
-                    chunk_start = chunk_id * current_chunk_size
-                    fh.seek(chunk_start)
-                    data = fh.read(current_chunk_size)
+            retry_ids = []
+            in_flight = {}
+            failed = False
+            
+            with ThreadPoolExecutor(max_workers=args.parallel) as pool:
+                while True:
+                    # Sliding window: at most `window` uploads (single chunks or
+                    # batches) are in flight, so memory stays bounded by
+                    # parallel x max(chunk size, BATCH_BYTES)
+                    while not failed and len(in_flight) < window:
+                        batch = []
+                        for chunk_id in islice(pending_ids, batch_size):
+                            # Calculate chunk position on the manifest grid
+                            chunk_start = chunk_id * chunk_size
+                            data = file_view[chunk_start:chunk_start + chunk_size]
+                            
+                            if not data:
+                                logger.warning(f"No data for chunk {chunk_id}, skipping")
+                                continue
+                            
+                            batch.append((chunk_id, data, checksums_by_id[chunk_id]))
+                        if not batch:
+                            break
+                        
+                        if len(batch) == 1:
+                            chunk_id, data, checksum = batch[0]
+                            future = pool.submit(send_chunk, file_id, chunk_id, data,
+                                                 checksum, args.max_retries, compress)
+                        else:
+                            future = pool.submit(send_batch, file_id, batch, args.max_retries, compress)
+                        in_flight[future] = [(chunk_id, len(data)) for chunk_id, data, _ in batch]
                     
-                    if not data:
-                        logger.warning(f"No data for chunk {chunk_id}, skipping")
-                        continue
+                    if not in_flight:
+                        break
                     
-                    checksum = hashlib.sha256(data).hexdigest()
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        chunks_sent = in_flight.pop(future)
+                        results = future.result()
+                        if len(chunks_sent) == 1:
+                            results = [results]
+                        
+                        for (chunk_id, chunk_len), (success, result) in zip(chunks_sent, results):
+                            if success:
+                                total_bytes_transferred += chunk_len
+                                completed_chunks += 1
+                                consecutive_failures = 0
+                                retry_count = 0
+                            else:
+                                logger.warning(f"⚠️  Chunk {chunk_id} failed, will retry in next iteration")
+                                retry_ids.append(chunk_id)
+                                if failed:
+                                    # Already in flight when the round failed; counted once per round
+                                    continue
+                                
+                                consecutive_failures += 1
+                                retry_count += 1
+                                
+                                if consecutive_failures >= max_consecutive_failures:
+                                    logger.error(f"❌ Too many consecutive failures ({consecutive_failures}), aborting")
+                                    sys.exit(2)
+                                
+                                if retry_count > args.max_retries * 2:
+                                    logger.error(f"❌ Too many total retries ({retry_count}), aborting")
+                                    sys.exit(2)
+                                
+                                failed = True  # Stop submitting; resend from the failed chunk once in-flight ones finish
                     
                     # Progress display
-                    completed_chunks = len(chunks_meta) - len(missing) + i
-                    print_progress(completed_chunks, len(chunks_meta), start_time, total_bytes_transferred)
-                    
-                    # Upload chunk
-                    success, result = upload_chunk(file_id, chunk_id, data, checksum, args.max_retries)
-                    
-                    if success:
-                        total_bytes_transferred += len(data)
-                        consecutive_failures = 0
-                        retry_count = 0
-                    else:
-                        consecutive_failures += 1
-                        retry_count += 1
-                        
-                        if consecutive_failures >= max_consecutive_failures:
-                            logger.error(f"❌ Too many consecutive failures ({consecutive_failures}), aborting")
-                            sys.exit(2)
-                        
-                        if retry_count > args.max_retries * 2:
-                            logger.error(f"❌ Too many total retries ({retry_count}), aborting")
-                            sys.exit(2)
-                        
-                        logger.warning(f"⚠️  Chunk {chunk_id} failed, will retry in next iteration")
-                        break  # Break inner loop to refresh missing chunks list
+                    print_progress(completed_chunks, total_chunks, start_time, total_bytes_transferred)
             
-            # Brief pause between iterations to avoid overwhelming the server
-            time.sleep(0.1)
+            # Next round: NACKed chunks first, then whatever was never issued
+            missing = retry_ids + list(pending_ids)
+            if not missing:
+                hashing.result()  # re-raises a hashing failure
+                if post_checksums:
+                    end_progress()
+                    logger.info("📤 Sending chunk checksums to server...")
+                    send_checksums(file_id, checksums_by_id)
+                    post_checksums = False
+                # Every chunk was ACKed; confirm once with the coordinator
+                missing = get_missing(file_id)
+                completed_chunks -= len(missing)
+                if not missing:
+                    break
         
-        print()  # New line after progress bar
+        end_progress()
         logger.info("✅ All chunks uploaded successfully!")
         
         # Request assembly
@@ -398,6 +854,7 @@ def main():
         assembly_result = assemble(file_id)
         
         if assembly_result.get('status') == 'ok':
+            clear_state(file_id)
             elapsed_total = time.time() - start_time
             avg_speed = size / elapsed_total if elapsed_total > 0 else 0
             
@@ -407,7 +864,7 @@ def main():
             logger.info(f"   • Average speed: {avg_speed / 1024:.1f} KB/s")
             logger.info(f"   • Success rate: {network_monitor.get_success_rate():.1%}")
             logger.info(f"   • Total retries: {retry_count}")
-            logger.info(f"   • Final chunk size: {current_chunk_size:,} bytes")
+            logger.info(f"   • Chunk size: {chunk_size:,} bytes")
             
             if 'path' in assembly_result:
                 logger.info(f"   • Server path: {assembly_result['path']}")
@@ -416,16 +873,20 @@ def main():
             sys.exit(3)
     
     except KeyboardInterrupt:
-        print()  # New line after progress bar
+        end_progress()
         logger.info("🛑 Transfer interrupted by user")
         logger.info("💡 You can resume this transfer later using the same file")
         sys.exit(130)
     
     except Exception as e:
-        print()  # New line after progress bar
+        end_progress()
         logger.error(f"💥 Unexpected error: {e}")
         logger.debug("Full traceback:", exc_info=True)
         sys.exit(1)
+    
+    finally:
+        # Unblock and stop hashing threads if the upload loop gave up early
+        stop_hashing.set()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Smart File Transfer System - Coordinator unit tests
+Drives coordinator/app.py through Flask's test client against a temp data dir
+
+Run with: python -m unittest test_coordinator
+"""
+
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+from pathlib import Path
+
+# The coordinator opens its database and log at import time
+DATA_DIR = tempfile.mkdtemp(prefix='sfts-test-')
+os.environ['SFTS_DATA_DIR'] = DATA_DIR
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'coordinator'))
+import app as coordinator  # noqa: E402
+
+def tearDownModule():
+    coordinator.close_db_connections()
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+def split(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+class CoordinatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = coordinator.app.test_client()
+
+    def init_transfer(self, data, chunk_size, defer=False):
+        """Open a transfer of data and return its file_id"""
+        file_id = str(uuid.uuid4())
+        manifest = {'file_id': file_id, 'filename': f'{file_id}.bin', 'size': len(data), 'chunk_size': chunk_size}
+        if defer:
+            manifest['defer_checksums'] = True
+        else:
+            manifest['chunks'] = [{'chunk_id': i, 'checksum': hashlib.sha256(chunk).hexdigest(), 'size': len(chunk)}
+                                  for i, chunk in enumerate(split(data, chunk_size))]
+        r = self.client.post('/upload/init', json=manifest)
+        self.assertEqual(r.status_code, 200, r.get_json())
+        return file_id
+
+    def put_chunk(self, file_id, chunk_id, chunk):
+        return self.client.put(f'/upload/chunk/{file_id}/{chunk_id}', data=chunk,
+                               headers={'X-Checksum': hashlib.sha256(chunk).hexdigest()})
+
+    def missing(self, file_id):
+        return self.client.get(f'/upload/missing/{file_id}').get_json()['missing']
+
+class TestReceivedBitmap(CoordinatorTestCase):
+    def test_missing_chunks(self):
+        self.assertEqual(coordinator._missing_chunks(bytes(2), 10), list(range(10)))
+        self.assertEqual(coordinator._missing_chunks(b'\xff\x03', 10), [])
+        self.assertEqual(coordinator._missing_chunks(b'\xff\x01', 10), [9])
+        self.assertEqual(coordinator._missing_chunks(b'\x5a\x00', 9), [0, 2, 5, 7, 8])
+        # Bits past the last chunk are padding, never reported
+        self.assertEqual(coordinator._missing_chunks(b'\xff', 3), [])
+        self.assertEqual(coordinator._missing_chunks(b'', 0), [])
+
+    def test_bit_functions_in_sql(self):
+        conn = coordinator.get_db_connection()
+        bitmap = conn.execute('SELECT set_bit(set_bit(zeroblob(2), 0), 9)').fetchone()[0]
+        self.assertEqual(bitmap, b'\x01\x02')
+        self.assertEqual([conn.execute('SELECT get_bit(?, ?)', (bitmap, i)).fetchone()[0] for i in range(16)],
+                         [1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0])
+
+    def test_chunks_fill_bitmap(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        self.assertEqual(self.missing(file_id), [0, 1, 2])
+        self.assertEqual(self.put_chunk(file_id, 1, data[4:8]).status_code, 200)
+        self.assertEqual(self.missing(file_id), [0, 2])
+
+    def test_duplicate_chunk_counted_once(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        self.assertEqual(self.put_chunk(file_id, 0, data[:4]).get_json()['received'], 1)
+        r = self.put_chunk(file_id, 0, data[:4])
+        self.assertTrue(r.get_json()['duplicate'])
+        # A fresh handler reads received_chunks back from the manifest row
+        coordinator._chunk_handlers.pop(file_id)
+        self.assertEqual(self.put_chunk(file_id, 2, data[8:]).get_json()['received'], 2)
+
+    def test_migrate_chunk_rows(self):
+        conn = sqlite3.connect(':memory:')
+        c = conn.cursor()
+        c.execute('CREATE TABLE manifests (file_id TEXT PRIMARY KEY, total_chunks INTEGER, '
+                  'received_chunks INTEGER, recv_bitmap BLOB, checksums BLOB)')
+        c.execute('CREATE TABLE chunks (file_id TEXT, chunk_id INTEGER, checksum TEXT, received INTEGER)')
+        c.execute("INSERT INTO manifests VALUES ('a', 10, 0, NULL, NULL)")
+        # Already migrated rows are left alone
+        c.execute("INSERT INTO manifests VALUES ('b', 1, 1, x'01', NULL)")
+        digest = hashlib.sha256(b'chunk').digest()
+        c.executemany('INSERT INTO chunks VALUES (?, ?, ?, ?)', [
+            ('a', 0, digest.hex(), 1),
+            ('a', 9, digest, 1),
+            ('a', 4, digest.hex(), 0),
+            ('a', 12, digest.hex(), 1),  # past total_chunks
+            ('b', 0, digest.hex(), 0),
+        ])
+        coordinator._migrate_chunk_rows(c, 'main')
+        bitmap, checksums, received = c.execute(
+            "SELECT recv_bitmap, checksums, received_chunks FROM manifests WHERE file_id = 'a'").fetchone()
+        self.assertEqual(coordinator._missing_chunks(bitmap, 10), [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(received, 2)
+        self.assertEqual(len(checksums), 32 * 10)
+        for chunk_id in (0, 4, 9):
+            self.assertEqual(checksums[32 * chunk_id:32 * (chunk_id + 1)], digest)
+        self.assertEqual(checksums[32:64], bytes(32))
+        self.assertEqual(c.execute("SELECT recv_bitmap, received_chunks FROM manifests WHERE file_id = 'b'").fetchone(),
+                         (b'\x01', 1))
+        self.assertIsNone(c.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks'").fetchone())
+        # Nothing left to migrate
+        coordinator._migrate_chunk_rows(c, 'main')
+
+def record(chunk_id, chunk, digest=None):
+    return coordinator.BATCH_RECORD.pack(chunk_id, len(chunk), digest or hashlib.sha256(chunk).digest()) + chunk
+
+class TestContainers(CoordinatorTestCase):
+    def test_close_waits_for_writers(self):
+        file_id = self.init_transfer(os.urandom(10), 4)
+        container = coordinator._get_container(file_id)
+        self.assertTrue(container.acquire())
+        coordinator._close_container(file_id)
+        # Still open for the writer that got in first, refused to new ones
+        os.fstat(container.fd)
+        self.assertFalse(container.acquire())
+        container.release()
+        self.assertRaises(OSError, os.fstat, container.fd)
+
+    def test_late_chunk_refused_after_close(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        handler = coordinator._chunk_handlers[file_id]
+        coordinator._close_container(file_id)
+        body, status, _ = handler(0, hashlib.sha256(data[:4]).digest(), io.BytesIO(data[:4]), time.time())
+        self.assertEqual(status, 409)
+        self.assertEqual(self.missing(file_id), [0, 1, 2])
+
+    def test_stale_transfer_releases_container(self):
+        file_id = self.init_transfer(os.urandom(10), 4)
+        container = coordinator._get_container(file_id)
+        conn = coordinator.get_db_connection()
+        conn.execute("UPDATE manifests SET created_at = datetime('now', '-2 hours') WHERE file_id = ?", (file_id,))
+        coordinator.cleanup_stale_transfers()
+        self.assertEqual(conn.execute('SELECT status FROM manifests WHERE file_id = ?', (file_id,)).fetchone()[0],
+                         'stale')
+        self.assertNotIn(file_id, coordinator._containers)
+        self.assertRaises(OSError, os.fstat, container.fd)
+        self.assertFalse(coordinator._container_path(file_id).exists())
+        # Late chunks for it are refused
+        self.assertEqual(self.put_chunk(file_id, 0, b'data').status_code, 409)
+
+class TestChunkBatches(CoordinatorTestCase):
+    def put_batch(self, file_id, body):
+        return self.client.put(f'/upload/chunks_batch/{file_id}', data=body,
+                               headers={'Content-Type': 'application/octet-stream'})
+
+    def test_batch_stores_every_chunk(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        r = self.put_batch(file_id, b''.join(record(i, chunk) for i, chunk in enumerate(split(data, 4))))
+        self.assertEqual(r.status_code, 200)
+        body = r.get_json()
+        self.assertEqual([res['code'] for res in body['results']], [200, 200, 200])
+        self.assertEqual((body['received'], body['total']), (3, 3))
+        self.assertEqual(self.missing(file_id), [])
+
+    def test_empty_batch(self):
+        file_id = self.init_transfer(os.urandom(10), 4)
+        r = self.put_batch(file_id, b'')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json()['results'], [])
+
+    def test_truncated_header(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        r = self.put_batch(file_id, record(0, data[:4]) + record(1, data[4:8])[:coordinator.BATCH_RECORD.size - 1])
+        self.assertEqual(r.status_code, 400)
+        body = r.get_json()
+        self.assertIn('Truncated', body['error'])
+        # Records before the damage are kept
+        self.assertEqual([res['chunk_id'] for res in body['results']], [0])
+        self.assertEqual(self.missing(file_id), [1, 2])
+
+    def test_truncated_data(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        r = self.put_batch(file_id, record(0, data[:4]) + record(1, data[4:8])[:-1])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([res['code'] for res in r.get_json()['results']], [200, 400])
+        self.assertEqual(self.missing(file_id), [1, 2])
+
+    def test_bad_digest_mid_batch(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        chunks = split(data, 4)
+        r = self.put_batch(file_id, record(0, chunks[0]) + record(1, chunks[1], bytes(32)) + record(2, chunks[2]))
+        self.assertEqual(r.status_code, 200)
+        results = r.get_json()['results']
+        self.assertEqual([res['code'] for res in results], [200, 400, 200])
+        self.assertEqual(results[1]['error'], 'Checksum verification failed')
+        self.assertEqual(self.missing(file_id), [1])
+        # The bad record's data was skipped, not read as the next header
+        self.assertEqual(self.put_batch(file_id, record(1, chunks[1])).get_json()['received'], 3)
+
+    def test_duplicate_ids_in_one_batch(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        chunks = split(data, 4)
+        r = self.put_batch(file_id, record(0, chunks[0]) + record(0, chunks[0]) + record(1, chunks[1]))
+        results = r.get_json()['results']
+        self.assertEqual([res['code'] for res in results], [200, 200, 200])
+        self.assertTrue(results[1]['duplicate'])
+        self.assertEqual(r.get_json()['received'], 2)
+        self.assertEqual(self.missing(file_id), [2])
+
+    def test_record_off_grid(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4)
+        r = self.put_batch(file_id, record(7, data[:4]) + record(2, data[8:]))
+        self.assertEqual([res['code'] for res in r.get_json()['results']], [400, 200])
+
+    def test_batch_too_large(self):
+        file_id = self.init_transfer(os.urandom(10), 4)
+        header = coordinator.BATCH_RECORD.pack(0, coordinator.app.config['MAX_CONTENT_LENGTH'], bytes(32))
+        r = self.put_batch(file_id, header)
+        self.assertEqual(r.status_code, 413)
+
+    def test_unknown_transfer(self):
+        r = self.put_batch(str(uuid.uuid4()), record(0, b'data'))
+        self.assertEqual(r.status_code, 404)
+
+class TestDeferredChecksums(CoordinatorTestCase):
+    def post_checksums(self, file_id, chunks):
+        return self.client.post(f'/upload/checksums/{file_id}',
+                                json={'checksums': [hashlib.sha256(chunk).hexdigest() for chunk in chunks]})
+
+    def deferred_upload(self, data, chunk_size):
+        file_id = self.init_transfer(data, chunk_size, defer=True)
+        for i, chunk in enumerate(split(data, chunk_size)):
+            self.assertEqual(self.put_chunk(file_id, i, chunk).status_code, 200)
+        return file_id
+
+    def test_assemble_waits_for_checksums(self):
+        data = os.urandom(10)
+        file_id = self.deferred_upload(data, 4)
+        r = self.client.post(f'/assemble/{file_id}')
+        self.assertEqual(r.status_code, 409)
+        r = self.post_checksums(file_id, split(data, 4))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json()['merkle'],
+                         hashlib.sha256(b''.join(hashlib.sha256(c).digest() for c in split(data, 4))).hexdigest())
+        r = self.client.post(f'/assemble/{file_id}')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(Path(r.get_json()['path']).read_bytes(), data)
+
+    def test_posted_twice(self):
+        data = os.urandom(10)
+        file_id = self.deferred_upload(data, 4)
+        first = self.post_checksums(file_id, split(data, 4)).get_json()
+        second = self.post_checksums(file_id, split(data, 4))
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.get_json()['merkle'], first['merkle'])
+
+    def test_merkle_mismatch(self):
+        data = os.urandom(10)
+        file_id = self.deferred_upload(data, 4)
+        merkle = self.post_checksums(file_id, split(data, 4)).get_json()['merkle']
+        r = self.post_checksums(file_id, split(os.urandom(10), 4))
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(r.get_json()['merkle'], merkle)
+        # A manifest sent with its checksums up front cannot be rewritten either
+        file_id = self.init_transfer(data, 4)
+        self.assertEqual(self.post_checksums(file_id, split(os.urandom(10), 4)).status_code, 409)
+        self.assertEqual(self.post_checksums(file_id, split(data, 4)).status_code, 200)
+
+    def test_invalid_checksums(self):
+        data = os.urandom(10)
+        file_id = self.init_transfer(data, 4, defer=True)
+        self.assertEqual(self.post_checksums(file_id, split(data, 4)[:2]).status_code, 400)
+        r = self.client.post(f'/upload/checksums/{file_id}', json={'checksums': ['zz'] * 3})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post(f'/upload/checksums/{file_id}', json={'checksums': ['00' * 16] * 3})
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.post_checksums(str(uuid.uuid4()), split(data, 4)).status_code, 404)
+
+    def test_completed_transfer(self):
+        data = os.urandom(10)
+        file_id = self.deferred_upload(data, 4)
+        self.post_checksums(file_id, split(data, 4))
+        self.client.post(f'/assemble/{file_id}')
+        self.assertEqual(self.post_checksums(file_id, split(data, 4)).status_code, 409)
+
+if __name__ == '__main__':
+    unittest.main()